@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Compare the per-record cost of filter_keys with the pre-compiled version
+"""
+
+import os
+import sys
+import copy
+import random
+import timeit
+import logging
+from argparse import ArgumentParser
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import condor_utils
+from condor_utils import classad, NOW
+
+now = datetime.utcnow()
+zero = datetime.utcfromtimestamp(0).isoformat()
+good_keys = {k: now if v is NOW else v for k, v in condor_utils.good_keys.items()}
+
+def legacy_filter_keys(data):
+    """filter_keys as it was before the coercion plan and epoch dates, for reference"""
+    for k in list(data):
+        if k.lower() == 'requestgpus' and k != 'Requestgpus':
+            data['Requestgpus'] = data[k]
+            del data[k]
+
+    for k in list(data.keys()):
+        if not (k in good_keys or ('IceProd' in k and not k.endswith('InstanceId'))):
+            del data[k]
+    for k in good_keys:
+        if k not in data:
+            data[k] = good_keys[k]
+        if isinstance(good_keys[k],bool):
+            try:
+                data[k] = bool(data[k])
+            except:
+                logging.info('bad bool [%s]: %r', k, data[k], exc_info=True)
+                data[k] = good_keys[k]
+        elif isinstance(good_keys[k],(float,int)):
+            if data[k] != classad.Value.Undefined:
+                try:
+                    data[k] = float(data[k])
+                except:
+                    logging.info('bad float/int [%s]: %r', k, data[k], exc_info=True)
+                    data[k] = good_keys[k]
+        elif isinstance(good_keys[k],datetime):
+            if isinstance(data[k], datetime):
+                data[k] = data[k].isoformat()
+            else:
+                try:
+                    data[k] = datetime.utcfromtimestamp(data[k]).isoformat()
+                except:
+                    logging.info('bad date [%s]: %r', k, data[k], exc_info=True)
+                    data[k] = zero
+        else:
+            data[k] = str(data[k])
+
+def make_ads(n, bad_fraction, seed=1):
+    """Job ads as read from history, with a fraction of malformed values"""
+    rand = random.Random(seed)
+    ads = []
+    for i in range(n):
+        ad = {
+            'ClusterId': 1000+i, 'ProcId': 0, 'JobStatus': 4,
+            'GlobalJobId': f'submit.example.org#{1000+i}.0#1700000000',
+            'Owner': 'user%d' % rand.randrange(50), 'Cmd': '/bin/true',
+            'AccountingGroup': 'group.user', 'RequestCpus': 1, 'RequestMemory': 2000,
+            'RequestDisk': 1000000, 'RemoteWallClockTime': 3600., 'CommittedTime': 3600,
+            'QDate': 1700000000, 'JobStartDate': 1700000100, 'JobCurrentStartDate': 1700000100,
+            'EnteredCurrentStatus': 1700003700, 'CompletionDate': 1700003700,
+            'ExitBySignal': False, 'ExitCode': 0, 'LastRemoteHost': 'slot1_1@node.example.org',
+            'MATCH_EXP_JOBGLIDEIN_ResourceName': 'CHTC', 'IceProdDataset': 21000+i%10,
+            'IceProdTaskInstanceId': 'x', 'Iwd': '/home/user', 'Environment': 'A=B',
+        }
+        if i % 3 == 0:
+            ad['RequestGPUs'] = 1
+        # attributes that filter_keys throws away
+        for j in range(60):
+            ad['Unused%d' % j] = j
+        if rand.random() < bad_fraction:
+            ad['RemoteUserCpu'] = 'not a number'
+            ad['CompletionDate'] = 'not a date'
+        ads.append(ad)
+    return ads
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--num', type=int, default=20000, help='number of ads')
+    parser.add_argument('--bad', type=float, default=0.05, help='fraction of ads with bad values')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of timing runs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    ads = make_ads(args.num, args.bad)
+
+    # both versions must agree, once dates are formatted for ES
+    for ad in ads[:1000]:
+        a, b = copy.deepcopy(ad), copy.deepcopy(ad)
+        legacy_filter_keys(a)
+        condor_utils.filter_keys(b)
+        condor_utils.isoformat_dates(b)
+        assert a == b, (a, b)
+
+    for name, func in (('legacy', legacy_filter_keys), ('compiled', condor_utils.filter_keys)):
+        best = float('inf')
+        for _ in range(args.repeat):
+            batch = [dict(ad) for ad in ads]
+            best = min(best, timeit.timeit(lambda: [func(ad) for ad in batch], number=1))
+        print(f'{name:>8}: {best/len(ads)*1e6:.2f} us/record, {len(ads)/best:.0f} records/s')
+    condor_utils.bad_values.clear()
+
+if __name__ == '__main__':
+    main()
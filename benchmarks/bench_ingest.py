@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Measure throughput and peak memory of the history ingestion stages.
+
+Runs offline: history files are synthetic (or given), and the ES bulk
+actions are serialized into a null sink instead of being sent anywhere.
+Each stage runs in a fresh process, so its peak RSS is its own.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from argparse import ArgumentParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+sys.path.insert(0, here)
+
+STAGES = ('parse', 'filter_keys', 'add_classads', 'es_actions', 'pipeline')
+
+def bulk_actions(entries, index='condor'):
+    """Build bulk actions the way condor_history_to_es.es_generator does"""
+    from condor_utils import add_classads, isoformat_dates
+    now = time.time()
+    for data in entries:
+        add_classads(data, now)
+        isoformat_dates(data)
+        data['_index'] = index + '-' + (data['date'].split('T')[0].replace('-','.'))
+        data['_id'] = data['GlobalJobId'].replace('#','-').replace('.','-')
+        if data['JobStatus'] == 4:
+            data['run_interval'] = {'gte': data['JobCurrentStartDate'], 'lte': data['EnteredCurrentStatus']}
+        if not data['_id']:
+            continue
+        yield data
+
+def null_sink(actions):
+    """Serialize actions to a bulk request body and throw it away.
+
+    Returns:
+        (int, int): number of actions, number of bytes
+    """
+    n = 0
+    size = 0
+    for data in actions:
+        meta = {'index': {'_index': data.pop('_index'), '_id': data.pop('_id')}}
+        size += len(json.dumps(meta)) + len(json.dumps(data, default=str)) + 2
+        n += 1
+    return n, size
+
+def run_stage(stage, filename):
+    """Run one stage over a history file.
+
+    Only the stage itself is timed; stages that work on parsed ads get
+    them parsed up front.
+
+    Returns:
+        dict: records, seconds, and peak RSS (MB) of this process
+    """
+    import condor_utils
+
+    if stage in ('filter_keys', 'add_classads', 'es_actions'):
+        ads = list(condor_utils.read_from_file(filename))
+
+    start = time.perf_counter()
+    if stage == 'parse':
+        records = sum(1 for _ in condor_utils.read_from_file(filename))
+    elif stage == 'filter_keys':
+        now = time.time()
+        for ad in ads:
+            condor_utils.filter_keys(ad, now)
+        records = len(ads)
+    elif stage == 'add_classads':
+        now = time.time()
+        for ad in ads:
+            condor_utils.add_classads(ad, now)
+        records = len(ads)
+    elif stage == 'es_actions':
+        records, _ = null_sink(bulk_actions(ads))
+    elif stage == 'pipeline':
+        records, _ = null_sink(bulk_actions(condor_utils.read_from_file(filename)))
+    else:
+        raise ValueError(f'unknown stage {stage}')
+    seconds = time.perf_counter() - start
+    condor_utils.bad_values.clear()
+
+    return {
+        'records': records,
+        'seconds': seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def run_isolated(stage, filename):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_stage, (stage, filename))
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--num', type=int, default=50000,
+                        help='number of synthetic ads per file (default 50000)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated stages to run (default all)')
+    parser.add_argument('--json', default=None,
+                        help='append results as a JSON line to this file, to track regressions')
+    parser.add_argument('files', nargs='*',
+                        help='history files to use instead of synthetic ones (plain and gzipped)')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage {stage}')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        files = args.files
+        if not files:
+            from synthetic_history import job_ads, write_history
+            files = [os.path.join(tmpdir, 'history'), os.path.join(tmpdir, 'history.gz')]
+            for filename in files:
+                write_history(filename, job_ads(args.num, seed=args.seed))
+
+        results = []
+        print(f'{"file":<20} {"stage":<14} {"records":>9} {"records/s":>11} {"peak RSS MB":>12}')
+        for filename in files:
+            for stage in stages:
+                if filename.endswith('.gz') and stage not in ('parse', 'pipeline'):
+                    # in-memory stages do not depend on the file format
+                    continue
+                r = run_isolated(stage, filename)
+                r.update(file=os.path.basename(filename), stage=stage)
+                results.append(r)
+                print(f'{r["file"]:<20} {stage:<14} {r["records"]:>9} {r["records"]/r["seconds"]:>11.0f} {r["peak_rss_mb"]:>12.1f}')
+
+    if args.json:
+        with open(args.json, 'a') as f:
+            json.dump({'revision': git_revision(), 'time': time.time(), 'results': results}, f)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Compare composing job metrics with per-ad Gauge.labels() calls against the
+vectorized JobBatch group-by, as condor_queue_to_prometheus does each cycle
+"""
+
+import os
+import sys
+import time
+import random
+import logging
+from argparse import ArgumentParser
+
+from prometheus_client import REGISTRY
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from condor_metrics import JobMetrics, JobBatch, SnapshotCollector, JOB_FAMILIES
+from condor_queue_to_prometheus import compose_ad_metrics, get_job_state
+
+def make_ads(n, seed=1):
+    """Queued job ads, as they are after add_classads"""
+    rand = random.Random(seed)
+    schedds = ['submit%d.example.org' % i for i in range(5)]
+    ads = []
+    for i in range(n):
+        ad = {
+            'GlobalJobId': f'{rand.choice(schedds)}#{1000+i}.0#1700000000',
+            'JobStatus': rand.choice((1, 1, 2, 5)),
+            'AccountingGroup': rand.choice(('IceCube.user', 'IceCube.sim', 'Undefined')),
+            'Owner': 'user%d' % rand.randrange(200),
+            'ExitCode': rand.choice((None, 0, 1)),
+            'RequestCpus': rand.choice((1, 1, 4)),
+            'RequestDisk': 1000000, 'RequestMemory': rand.choice((1000, 4000)),
+            'JobCurrentStartDate': 1700000000 + rand.randrange(3600),
+            'RemoteUserCpu': rand.random() * 1000,
+            'DiskUsage_RAW': 1000, 'ResidentSetSize_RAW': 100000,
+        }
+        if i % 3 == 0:
+            ad['RequestGpus'] = 1
+        ads.append(ad)
+    return ads
+
+def legacy_compose(metrics, ads, now):
+    """compose_ad_metrics as it was before JobBatch, for reference"""
+    for ad in ads:
+        walltime = int(ad['RequestCpus']) * (now - ad['JobCurrentStartDate'])
+        labels = {key: None for key in metrics.labels}
+        labels['schedd'] = ad['GlobalJobId'].split('#')[0]
+        labels['state'] = get_job_state(ad)
+        try:
+            group = ad['AccountingGroup'].split('.')[0]
+        except Exception:
+            group = "None"
+        if group == 'Undefined': group = 'None'
+        labels['group'] = group
+        labels['owner'] = ad['Owner']
+        metrics.condor_jobs_cpu_request.labels(**labels).inc(float(ad['RequestCpus']))
+        metrics.condor_jobs_disk_request_bytes.labels(**labels).inc(float(ad['RequestDisk'])*1024)
+        metrics.condor_jobs_memory_request_bytes.labels(**labels).inc(float(ad['RequestMemory'])*1024*1024)
+        metrics.condor_jobs_count.labels(**{'exit_code': ad['ExitCode'],**labels}).inc()
+        metrics.condor_jobs_cputime.labels(**labels).inc(ad['RemoteUserCpu'])
+        metrics.condor_jobs_disk_usage_bytes.labels(**labels).inc(ad['DiskUsage_RAW']*1024)
+        metrics.condor_jobs_memory_usage_bytes.labels(**labels).inc(ad['ResidentSetSize_RAW']*1024)
+        metrics.condor_jobs_walltime.labels(**labels).inc(walltime)
+        metrics.condor_jobs_wastetime.labels(**labels).inc(walltime - ad['RemoteUserCpu'])
+        if 'RequestGpus' in ad:
+            metrics.condor_jobs_gpu_request.labels(**labels).inc(ad['RequestGpus'])
+
+def batch_compose(collector, ads, now):
+    batch = JobBatch()
+    compose_ad_metrics(ads, now, batch)
+    snapshot = collector.new_snapshot()
+    batch.fill(snapshot)
+    collector.publish(snapshot)
+
+def samples(families):
+    return {(s.name, tuple(sorted(s.labels.items()))): s.value
+            for family in families for s in family.samples
+            if family.name in JOB_FAMILIES}
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--num', type=int, nargs='+', default=[100000, 1000000], help='number of ads')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of timing runs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    metrics = JobMetrics()
+    collector = SnapshotCollector(JOB_FAMILIES, registry=None)
+    now = 1700007200
+
+    for n in args.num:
+        ads = make_ads(n)
+
+        # both must publish the same series
+        metrics.clear()
+        legacy_compose(metrics, ads[:20000], now)
+        batch_compose(collector, ads[:20000], now)
+        a, b = samples(REGISTRY.collect()), samples(collector.collect())
+        assert a.keys() == b.keys(), a.keys() ^ b.keys()
+        assert all(abs(a[k] - b[k]) <= 1e-9 * max(1, abs(a[k])) for k in a)
+
+        for name, func in (('labels', lambda: legacy_compose(metrics, ads, now)),
+                           ('groupby', lambda: batch_compose(collector, ads, now))):
+            best = float('inf')
+            for _ in range(args.repeat):
+                metrics.clear()
+                start = time.perf_counter()
+                func()
+                best = min(best, time.perf_counter() - start)
+            print(f'{n:>8} ads {name:>8}: {best:.3f} s, {n/best:.0f} ads/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Write synthetic condor history files for benchmarking
+"""
+
+import gzip
+import random
+from argparse import ArgumentParser
+
+gpu_names = [
+    'NVIDIA GeForce GTX 1080 Ti', 'NVIDIA GeForce GTX 1080', 'Tesla V100-SXM2-16GB',
+    'NVIDIA A100-SXM4-40GB', 'NVIDIA A40', 'Quadro RTX 6000', 'Tesla T4', 'NVIDIA H100 80GB HBM3',
+]
+glidein_resources = [
+    ('CHTC', 'CHTC', 'execute.chtc.wisc.edu'),
+    ('Nebraska', 'Nebraska', 'red.unl.edu'),
+    ('MWT2', 'MWT2', 'mwt2.org'),
+    ('SDSC-PRP', 'SDSC-PRP', 'nautilus.optiputer.net'),
+    ('Anvil', 'Purdue Anvil', 'anvil.rcac.purdue.edu'),
+    ('DESY-ZN', 'DESY-ZN', 'zeuthen.desy.de'),
+    ('other', 'other', 'compute.example.org'),
+]
+local_domain = 'icecube.wisc.edu'
+owners = ['ice3simusr', 'alice', 'bob', 'carol', 'dave', 'erin']
+
+# attributes jobs carry that the pipeline throws away
+filler = {
+    'Args': '"--seed 1234 --nevents 1000 --gcd /cvmfs/icecube.opensciencegrid.org/data/GCD/GeoCalibDetectorStatus.i3.gz"',
+    'Environment': '"HOME=/home/user PATH=/usr/bin:/bin X509_USER_PROXY=/tmp/x509"',
+    'Iwd': '"/scratch/user/job"',
+    'In': '"/dev/null"',
+    'Out': '"job.out"',
+    'Err': '"job.err"',
+    'JobUniverse': '5',
+    'JobPrio': '0',
+    'Rank': '0.0',
+    'Requirements': '((TARGET.Arch == "X86_64") && (TARGET.OpSys == "LINUX")) && (TARGET.Disk >= RequestDisk) && (TARGET.Memory >= RequestMemory)',
+    'PeriodicRemove': '(JobStatus == 5) && (CurrentTime - EnteredCurrentStatus > 86400)',
+    'TransferInput': '"input.tar.gz,config.json"',
+    'ShouldTransferFiles': '"YES"',
+    'WhenToTransferOutput': '"ON_EXIT"',
+    'WantRemoteIO': 'true',
+    'NiceUser': 'false',
+    'OnExitRemove': 'true',
+    'LeaveJobInQueue': 'false',
+    'JobNotification': '0',
+    'CoreSize': '0',
+    'BufferSize': '524288',
+    'BufferBlockSize': '32768',
+    'MyType': '"Job"',
+    'TargetType': '"Machine"',
+}
+for i in range(40):
+    filler['Extra_Attr_%d' % i] = str(i)
+
+def job_ads(n, seed=1, gpu_fraction=0.3, glidein_fraction=0.7, bad_fraction=0.02, expr_fraction=0.05):
+    """Generate job ads as attribute: ClassAd text dicts.
+
+    Args:
+        n (int): number of ads
+        seed (int): random seed
+        gpu_fraction (float): fraction of jobs requesting a GPU
+        glidein_fraction (float): fraction of jobs that ran in glideins (the rest ran locally)
+        bad_fraction (float): fraction of jobs with malformed attribute values
+        expr_fraction (float): fraction of jobs with an expression for RequestMemory
+    """
+    rand = random.Random(seed)
+    for i in range(n):
+        cluster = 1000000 + i
+        qdate = 1700000000 + i*10
+        start = qdate + rand.randrange(60, 7200)
+        walltime = rand.randrange(60, 86400)
+        end = start + walltime
+        status = rand.choice((3, 4, 4, 4, 4))
+        ad = {
+            'ClusterId': str(cluster),
+            'ProcId': '0',
+            'GlobalJobId': '"submit.%s#%d.0#%d"' % (local_domain, cluster, qdate),
+            'Owner': '"%s"' % rand.choice(owners),
+            'AccountingGroup': '"%s.%s"' % (rand.choice(('sim', 'ana', 'prod')), rand.choice(owners)),
+            'Cmd': '"/home/user/run.sh"',
+            'JobStatus': str(status),
+            'LastJobStatus': '2',
+            'ExitCode': str(rand.choice((0, 0, 0, 1))),
+            'ExitBySignal': 'false',
+            'QDate': str(qdate),
+            'JobStartDate': str(start),
+            'JobCurrentStartDate': str(start),
+            'JobLastStartDate': str(start),
+            'EnteredCurrentStatus': str(end),
+            'CompletionDate': str(end if status == 4 else 0),
+            'RemoteWallClockTime': '%d.0' % walltime,
+            'CommittedTime': str(walltime),
+            'CumulativeSlotTime': '%d.0' % walltime,
+            'RemoteUserCpu': '%d.0' % int(walltime*0.9),
+            'RemoteSysCpu': '%d.0' % int(walltime*0.01),
+            'RequestCpus': '1',
+            'RequestMemory': str(rand.choice((1000, 2000, 4000, 8000))),
+            'RequestDisk': '1000000',
+            'ResidentSetSize_RAW': str(rand.randrange(100000, 4000000)),
+            'ImageSize_RAW': str(rand.randrange(100000, 4000000)),
+            'DiskUsage_RAW': str(rand.randrange(1000, 1000000)),
+            'BytesSent': '%d.0' % rand.randrange(10**6, 10**9),
+            'BytesRecvd': '%d.0' % rand.randrange(10**6, 10**9),
+            'NumJobStarts': '1',
+            'NumShadowStarts': '1',
+            'LastMatchTime': str(start),
+            'StartdPrincipal': '"execute-side@matchsession/128.104.%d.%d"' % (rand.randrange(256), rand.randrange(256)),
+        }
+        ad.update(filler)
+        if rand.random() < gpu_fraction:
+            ad['RequestGPUs'] = '1'
+            ad['MachineAttrGPUs_DeviceName0'] = '"%s"' % rand.choice(gpu_names)
+        if rand.random() < glidein_fraction:
+            site, resource, domain = rand.choice(glidein_resources)
+            ad['MATCH_EXP_JOBGLIDEIN_ResourceName'] = '"%s"' % resource
+            ad['MachineAttrGLIDEIN_Site0'] = '"%s"' % site
+            ad['MachineAttrGLIDEIN_SiteResource0'] = '"%s"' % resource
+            ad['LastRemoteHost'] = '"slot1_%d@glidein_%d_%d@node%d.%s"' % (
+                rand.randrange(1, 8), rand.randrange(10000), rand.randrange(10**6), rand.randrange(500), domain)
+            ad['IceProdDataset'] = str(rand.randrange(21000, 21100))
+            ad['IceProdTaskName'] = '"%s"' % rand.choice(('generate', 'photon', 'detector', 'level2'))
+            ad['IceProdTaskInstanceId'] = '"%032x"' % rand.getrandbits(128)
+        else:
+            ad['LastRemoteHost'] = '"slot1@%s.%s"' % (rand.choice(('gtx-05', 'gtx-21', 'rad-3', 'cpu-110')), local_domain)
+        if rand.random() < expr_fraction:
+            ad['RequestMemory'] = 'ifThenElse(MemoryUsage =!= undefined,MemoryUsage,2000)'
+        if rand.random() < bad_fraction:
+            ad['RemoteUserCpu'] = '"n/a"'
+            ad['QDate'] = 'undefined'
+            ad['CompletionDate'] = '"never"'
+        yield ad
+
+def format_ad(ad):
+    """Format an ad as it appears in a history file, including the banner line"""
+    lines = ['%s = %s\n' % item for item in ad.items()]
+    lines.append('*** Offset = 0 ClusterId = %s ProcId = 0 Owner = %s CompletionDate = %s\n' % (
+        ad['ClusterId'], ad['Owner'], ad['CompletionDate']))
+    return ''.join(lines)
+
+def write_history(filename, ads):
+    """Write ads to a history file, gzipped if `filename` ends in .gz
+
+    Returns:
+        int: number of ads written
+    """
+    n = 0
+    with (gzip.open(filename, 'wt') if filename.endswith('.gz') else open(filename, 'w')) as f:
+        for ad in ads:
+            f.write(format_ad(ad))
+            n += 1
+    return n
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--num', type=int, default=100000, help='number of ads')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--gpu', type=float, default=0.3, help='fraction of GPU jobs')
+    parser.add_argument('--glidein', type=float, default=0.7, help='fraction of glidein jobs')
+    parser.add_argument('--bad', type=float, default=0.02, help='fraction of jobs with bad values')
+    parser.add_argument('filename', help='history file to write (gzipped if it ends in .gz)')
+    args = parser.parse_args()
+
+    ads = job_ads(args.num, seed=args.seed, gpu_fraction=args.gpu,
+                  glidein_fraction=args.glidein, bad_fraction=args.bad)
+    n = write_history(args.filename, ads)
+    print(f'wrote {n} ads to {args.filename}')
+
+if __name__ == '__main__':
+    main()
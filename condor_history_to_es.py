@@ -6,6 +6,12 @@ Read from condor history and write to elasticsearch
 
 import os
 import glob
+import time
+import atexit
+import shutil
+import tempfile
+import multiprocessing
+from collections import deque
 from argparse import ArgumentParser
 import logging
 from functools import partial
@@ -28,33 +34,64 @@ parser.add_argument('--client_id', help='oauth2 client id', default=None)
 parser.add_argument('--client_secret', help='oauth2 client secret', default=None)
 parser.add_argument('--token_url', help='oauth2 realm token url', default=None)
 parser.add_argument('--token', help='oauth2 token',default=None)
+parser.add_argument('--checkpoint', default=None,
+                    help='sqlite file recording how far each history file has been indexed')
+parser.add_argument('--watch', default=False, action='store_true',
+                    help='keep watching history files/directories for new ads (requires --checkpoint)')
+parser.add_argument('--watch-interval', default=60, type=int,
+                    help='seconds between scans in --watch mode (default 60)')
+parser.add_argument('--workers', default=1, type=int,
+                    help='number of processes parsing and indexing history files in parallel (default 1)')
+parser.add_argument('--dead-letter', default=None,
+                    help='directory to keep rejected documents in, for replay with es_dead_letter.py')
+parser.add_argument('--metrics-textfile', default=None,
+                    help='write pipeline stage metrics to this node_exporter textfile (.prom)')
 parser.add_argument("positionals", nargs='+')
 
 options = parser.parse_args()
 if not options.positionals:
     parser.error('no condor history files or collectors')
+if options.watch and not options.checkpoint:
+    parser.error('--watch requires --checkpoint')
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s : %(message)s')
 
+if options.workers > 1 and options.metrics_textfile and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+    # workers keep their stage metrics in files that are summed up for the
+    # textfile, which prometheus_client has to know before it is imported
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='condor_history_metrics.')
+    atexit.register(shutil.rmtree, os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+
 import htcondor2 as htcondor
 from condor_utils import *
+from history_checkpoint import HistoryCheckpoint
+from es_dead_letter import DeadLetterQueue, error_counts
+import stage_metrics
+from stage_metrics import StageTimer
 
 def es_generator(entries):
-    for data in entries:
-        add_classads(data)
-        data['_index'] = options.indexname
-        if options.dailyindex:
-            data['_index'] += '-'+(data['date'].split('T')[0].replace('-','.'))
-        data['_id'] = data['GlobalJobId'].replace('#','-').replace('.','-')
-        if data['JobStatus'] == 4:
-            data['run_interval'] = {'gte': data['JobCurrentStartDate'], 'lte': data['EnteredCurrentStatus']}
-        if not data['_id']:
-            continue
-        yield data
+    now = time.time()
+    timer = StageTimer('add_classads')
+    try:
+        for data in entries:
+            with timer:
+                add_classads(data, now)
+                isoformat_dates(data)
+            data['_index'] = options.indexname
+            if options.dailyindex:
+                data['_index'] += '-'+(data['date'].split('T')[0].replace('-','.'))
+            data['_id'] = data['GlobalJobId'].replace('#','-').replace('.','-')
+            if data['JobStatus'] == 4:
+                data['run_interval'] = {'gte': data['JobCurrentStartDate'], 'lte': data['EnteredCurrentStatus']}
+            if not data['_id']:
+                continue
+            yield data
+    finally:
+        timer.flush()
 
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import BulkIndexError
-from elasticsearch.helpers import streaming_bulk
+from es_bulk import streaming_bulk, ack_results
 
 prefix = 'http'
 address = options.address
@@ -73,36 +110,128 @@ elif None not in (options.token_url, options.client_secret, options.client_id):
     token = api.make_access_token()
 
 url = '{}://{}'.format(prefix, address)
-logging.info('connecting to ES at %s',url)
-es = Elasticsearch(hosts=[url],
-                   request_timeout=5000,
-                   bearer_auth=token,
-                   sniff_on_node_failure=True)
 
-def es_import(document_generator):
+def es_connect():
+    logging.info('connecting to ES at %s',url)
+    return Elasticsearch(hosts=[url],
+                         request_timeout=5000,
+                         bearer_auth=token,
+                         sniff_on_node_failure=True)
+
+es = es_connect()
+
+def es_import(document_generator, on_ack=None, chunk_size=500):
+    """Index documents, calling `on_ack(n)` every time another `chunk_size`
+    documents have been acknowledged, where n is the total number of documents acknowledged so far.
+    Documents after one that failed are never acknowledged.
+
+    With --dead-letter, rejected documents are written there and count as acknowledged.
+    """
     if options.dry_run:
         import json
         import sys
+        successes = 0
         for hit in document_generator:
             json.dump(hit, sys.stdout)
-        success = True
+            successes += 1
     else:
         successes = 0
+        dead_letter = DeadLetterQueue(options.dead_letter) if options.dead_letter else None
         try:
-            for success, _ in streaming_bulk(es, document_generator, max_retries=20, initial_backoff=10, max_backoff=360):
+            results = streaming_bulk(es, document_generator, max_retries=20, initial_backoff=10, max_backoff=360,
+                                     dead_letter=dead_letter)
+            if on_ack:
+                results = ack_results(results, on_ack, chunk_size, dead_letter=bool(dead_letter))
+            for success, _ in results:
                 successes += success
         except BulkIndexError as e:
-            for error in e.errors:
-                print(error)
+            logging.error('%d documents failed to index: %s', len(e.errors), dict(error_counts(e.errors)))
+        finally:
+            if dead_letter:
+                dead_letter.close()
 
         print(f"Indexed {successes} documents")
+    log_bad_values()
     return successes
 
+def import_file(filename, checkpoint=None):
+    """Index the ads in a history file, resuming from and updating `checkpoint`"""
+    offset = 0
+    if checkpoint:
+        size = os.stat(filename).st_size
+        offset = checkpoint.resume_offset(filename)
+        if offset is None:
+            logging.debug('%s is unchanged, skipping', filename)
+            return 0
+        if offset:
+            logging.info('resuming %s at offset %d', filename, offset)
+
+    # offsets of documents handed to the indexer that have not been acknowledged yet
+    pending = deque()
+    position = offset
+    acked = 0
+
+    def track(entries):
+        nonlocal position
+        for position, data in entries:
+            yield data
+
+    def documents():
+        for doc in es_generator(track(read_from_file_offsets(filename, offset))):
+            pending.append(position)
+            yield doc
+
+    def on_ack(n):
+        nonlocal acked
+        pos = None
+        while acked < n:
+            pos = pending.popleft()
+            acked += 1
+        if pos is not None:
+            checkpoint.update(filename, pos, size=size)
+
+    success = es_import(documents(), on_ack=on_ack if checkpoint else None)
+    if checkpoint and not options.dry_run and not pending:
+        # every document was acknowledged, so the whole file is done
+        checkpoint.update(filename, position, complete=True, size=size)
+    logging.info('finished processing %s', filename)
+    return success
+
+def history_files(paths):
+    """Expand history file globs and directories, oldest first"""
+    filenames = set()
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, 'history*')
+        filenames.update(f for f in glob.glob(path) if os.path.isfile(f))
+    return sorted(filenames, key=os.path.getmtime)
+
+checkpoint = None
+
+def init_worker():
+    """Give each worker process its own ES connection and checkpoint handle"""
+    global es, checkpoint
+    es = es_connect()
+    if options.checkpoint:
+        checkpoint = HistoryCheckpoint(options.checkpoint)
+
+def import_file_logged(filename):
+    """Like `import_file`, but log errors instead of raising, so one bad
+    file (e.g. rotated away while scanning) does not stop the others"""
+    try:
+        return import_file(filename, checkpoint)
+    except Exception:
+        logging.error('failed to import %s', filename, exc_info=True)
+        return 0
+
+def import_file_worker(filename):
+    return filename, import_file_logged(filename)
+
 failed = False
 if options.access_points and options.collectors:
     for coll_address in options.positionals:
         try:
-            gen = es_generator(read_from_collector(coll_address, options.access_points, history=True))
+            gen = es_generator(read_from_collector(coll_address, options.access_points, history=True, projection=job_projection(iceprod_keys)))
             success = es_import(gen)
         except htcondor.HTCondorException as e:
             failed = e
@@ -110,18 +239,47 @@ if options.access_points and options.collectors:
 elif options.collectors:
     for coll_address in options.positionals:
         try:
-            gen = es_generator(read_from_collector(coll_address, history=True))
+            gen = es_generator(read_from_collector(coll_address, history=True, projection=job_projection(iceprod_keys)))
             success = es_import(gen)
         except htcondor.HTCondorException as e:
             failed = e
             logging.error('Condor error', exc_info=True)
 else:
     print(options.positionals)
-    for path in options.positionals:
-        for filename in glob.glob(path):
-            gen = es_generator(read_from_file(filename))
-            success = es_import(gen)
-            logging.info('finished processing %s', filename)
+    pool = None
+    # fork workers before opening the checkpoint db, so it is not shared
+    if options.workers > 1:
+        pool = multiprocessing.Pool(options.workers, initializer=init_worker)
+    if options.checkpoint:
+        checkpoint = HistoryCheckpoint(options.checkpoint)
+    while True:
+        start = time.time()
+        filenames = history_files(options.positionals)
+        if pool:
+            successes = 0
+            results = pool.imap_unordered(import_file_worker, filenames)
+            for i, (filename, success) in enumerate(results):
+                successes += success
+                logging.info('%d/%d files done, last was %s', i+1, len(filenames), filename)
+            print(f"Indexed {successes} documents from {len(filenames)} files")
+        else:
+            for filename in filenames:
+                success = import_file_logged(filename)
+        if checkpoint:
+            checkpoint.prune()
+        if options.metrics_textfile:
+            stage_metrics.write_textfile(options.metrics_textfile)
+        if not options.watch:
+            break
+        delta = time.time() - start
+        if delta < options.watch_interval:
+            time.sleep(options.watch_interval - delta)
+    if pool:
+        pool.close()
+        pool.join()
+
+if options.metrics_textfile:
+    stage_metrics.write_textfile(options.metrics_textfile)
 
 if failed:
     raise failed
@@ -3,15 +3,19 @@
 
 import os
 import glob
-import gzip
 from optparse import OptionParser
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from condor_utils import read_from_file, classad
 
 parser = OptionParser('usage: %prog [options] history_files')
 parser.add_option('-m','--mongo',help='mongodb host')
 parser.add_option('--clear', default=False, action='store_true',
                   help='clear db table before import')
+parser.add_option('-b','--batch-size', default=1000, type='int',
+                  help='number of jobs per bulk write (default 1000)')
 (options, args) = parser.parse_args()
 if not args:
     parser.error('no condor history files')
@@ -23,23 +27,13 @@ if options.mongo:
 db = MongoClient(**mongo_args).condor
 if options.clear:
     db.condor_history.drop()
-    db.condor_history.create_index("GlobalJobId")
-    db.condor_history.create_index("JobStatus")
-
-def get_type(val):
-    if val == 'false':
-        return False
-    elif val == 'true':
-        return True
-    elif val.startswith('"') and val.endswith('"') and '"' not in val[1:-1]:
-        return val[1:-1]
-    try:
-        return int(val)
-    except:
-        try:
-            return float(val)
-        except:
-            return val
+try:
+    # unique, so that re-importing a file updates jobs instead of duplicating them
+    db.condor_history.create_index("GlobalJobId", unique=True)
+except OperationFailure as e:
+    print('could not create unique GlobalJobId index, drop the existing one or use --clear:', e)
+    raise
+db.condor_history.create_index("JobStatus")
 
 good_keys = set(['JobStatus','Cmd','Owner','AccountingGroup',
 'ImageSize_RAW','DiskUsage_RAW','ExecutableSize_RAW',
@@ -57,34 +51,45 @@ good_keys = set(['JobStatus','Cmd','Owner','AccountingGroup',
 'LastJobStatus','LastHoldReason','LastRemotePool',
 ])
 
-def filter_keys(data):
-    for k in list(data.keys()):
-        if k not in good_keys:
-            del data[k]
+def bson_value(val):
+    """Evaluated expressions may be classad values, store those as text"""
+    if isinstance(val, (str, int, float, bool)):
+        return val
+    return str(val)
+
+def is_unset(val):
+    """None, or an Undefined/Error classad value"""
+    return val is None or isinstance(val, classad.Value)
 
-def insert(data):
-    ret = db.condor_history.find_one({'GlobalJobId':data['GlobalJobId']})
-    if not ret:
-        db.condor_history.insert_one(entry)
-    else:
-        diff = {}
-        for k in set(data).difference(ret):
-            diff[k] = data[k]
-        if diff:
-            db.condor_history.update_one({'GlobalJobId':data['GlobalJobId']},
-                                         {'$set':diff})
+def upsert(data):
+    """Insert a job, or add the attributes an existing job does not have yet"""
+    return UpdateOne(
+        {'GlobalJobId': data['GlobalJobId']},
+        # aggregation pipeline update: only fill in missing fields, leaving
+        # fields that exist (even as null) alone
+        [{'$set': {
+            k: {'$cond': [{'$eq': [{'$type': '$'+k}, 'missing']}, {'$literal': bson_value(v)}, '$'+k]}
+            for k,v in data.items() if not is_unset(v)
+        }}],
+        upsert=True,
+    )
+
+def insert(ops):
+    try:
+        db.condor_history.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        print('bulk write errors:', e.details['writeErrors'][:10])
 
 for path in args:
     for filename in glob.iglob(path):
-        with (gzip.open(filename) if filename.endswith('.gz') else open(filename)) as f:
-            entry = {}
-            for line in f.readlines():
-                if line.startswith('***'):
-                    filter_keys(entry)
-                    insert(entry)
-                    entry = {}
-                else:
-                    name,value = line.split('=',1)
-                    entry[name.strip()] = get_type(value.strip())
+        ops = []
+        for entry in read_from_file(filename, keys=good_keys.__contains__):
+            if 'GlobalJobId' not in entry:
+                continue
+            ops.append(upsert(entry))
+            if len(ops) >= options.batch_size:
+                insert(ops)
+                ops = []
+        if ops:
+            insert(ops)
         print('.',end='')
-
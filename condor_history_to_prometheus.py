@@ -1,22 +1,30 @@
 #!/usr/bin/env python3
 from optparse import OptionParser
+import os
+import json
 import logging
 import htcondor2 as htcondor
 from condor_utils import *
-from condor_job_metrics import JobMetrics
+from condor_job_metrics import JobMetrics, JOB_LABELS
 import datetime
 import time
 import prometheus_client
 from datetime import datetime
 from collections import defaultdict
 from socket import gethostbyname
-
-utc_format = '%Y-%m-%dT%H:%M:%S'
+import stage_metrics
+from stage_metrics import stage, StageTimer, timed_schedd
 
 def generate_ads(entries):
-    for data in entries:
-        add_classads(data)
-        yield data
+    now = time.time()
+    timer = StageTimer('add_classads')
+    try:
+        for data in entries:
+            with timer:
+                add_classads(data, now)
+            yield data
+    finally:
+        timer.flush()
 
 def last_jobs_dict(collector, access_points):
     last_job = defaultdict(dict)
@@ -34,18 +42,19 @@ def last_jobs_dict(collector, access_points):
 def locate_schedds(collector, access_points=None):
     coll = htcondor.Collector(collector)
     schedds = []
-    if access_points:
-        try:
-            for ap in access_points:
-                logging.debug(f"getting {ap} schedd ad")
-                schedds.append(coll.locate(htcondor.DaemonTypes.Schedd, ap))
-        except Exception as e:
-            logging.error(f'Condor error: {e}')
-    else:
-        try:
-            schedds.append(coll.locateAll(htcondor.DaemonTypes.Schedd))
-        except Exception as e:
-            logging.error(f'Condor error: {e}')
+    with stage('collector_locate'):
+        if access_points:
+            try:
+                for ap in access_points:
+                    logging.debug(f"getting {ap} schedd ad")
+                    schedds.append(coll.locate(htcondor.DaemonTypes.Schedd, ap))
+            except Exception as e:
+                logging.error(f'Condor error: {e}')
+        else:
+            try:
+                schedds.append(coll.locateAll(htcondor.DaemonTypes.Schedd))
+            except Exception as e:
+                logging.error(f'Condor error: {e}')
     return schedds
 
 def compose_ad_metrics(ad, metrics):
@@ -102,12 +111,13 @@ def compose_ad_metrics(ad, metrics):
     elif labels['MachineAttrGLIDEIN_Site0'] !=  'other':
         labels['MATCH_EXP_JOBGLIDEIN_ResourceName'] = labels['MachineAttrGLIDEIN_Site0']
 
-    metrics.condor_job_count.labels(**labels).inc()
-    metrics.condor_job_walltime_hours.labels(**labels).inc(ad['walltimehrs'])
-    metrics.condor_job_resource_hours.labels(**labels).inc(resource_hrs)
-    metrics.condor_job_resource_req.labels(**labels).observe(resource_request)
-    metrics.condor_job_mem_req.labels(**labels).observe(ad['RequestMemory']/1024)
-    metrics.condor_job_mem_used.labels(**labels).observe(ad['ResidentSetSize_RAW']/1048576)
+    metrics.fold(labels)
+    metrics.child('condor_job_count', labels).inc()
+    metrics.child('condor_job_walltime_hours', labels).inc(ad['walltimehrs'])
+    metrics.child('condor_job_resource_hours', labels).inc(resource_hrs)
+    metrics.child('condor_job_resource_req', labels).observe(resource_request)
+    metrics.child('condor_job_mem_req', labels).observe(ad['RequestMemory']/1024)
+    metrics.child('condor_job_mem_used', labels).observe(ad['ResidentSetSize_RAW']/1048576)
 
 def query_collector(collector, access_points, metrics, last_job):
     """Query schedds for job ads
@@ -120,7 +130,7 @@ def query_collector(collector, access_points, metrics, last_job):
     for schedd_ad in locate_schedds(collector, access_points):
         name = schedd_ad.get('Name')
 
-        ads = read_from_schedd(schedd_ad, history=True, since=last_job[name]['ClusterId'])
+        ads = read_from_schedd(schedd_ad, history=True, projection=job_projection(iceprod_keys), since=last_job[name]['ClusterId'])
         iterate_ads(ads, name, metrics, last_job)
 
 def read_from_schedd(schedd_ad, history=False, constraint='true', projection=[],match=10000,since=None):
@@ -138,6 +148,7 @@ def read_from_schedd(schedd_ad, history=False, constraint='true', projection=[],
         import htcondor2 as htcondor
         logging.info('getting job ads from %s', schedd_ad['Name'])
         schedd = htcondor.Schedd(schedd_ad)
+        timer = StageTimer('classad_to_dict')
         try:
             i = 0
             if history:
@@ -149,27 +160,45 @@ def read_from_schedd(schedd_ad, history=False, constraint='true', projection=[],
                 gen = schedd.history(constraint,projection,match=match,since=since)
             else:
                 gen = schedd.query(constraint, projection)
-            for i,entry in enumerate(gen):
-                yield classad_to_dict(entry)
+            for i,entry in enumerate(timed_schedd(schedd_ad['Name'], gen)):
+                with timer:
+                    data = classad_to_dict(entry)
+                yield data
             logging.info('got %d entries', i)
         except Exception:
             logging.info('%s failed', schedd_ad['Name'], exc_info=True)
+        finally:
+            timer.flush()
 
 def iterate_ads(ads, name, metrics, last_job):
     if last_job[name]['EnteredCurrentStatus'] is not None:
-        logging.info(f'{name} - read ads since {last_job[name]["ClusterId"]}:{last_job[name]["EnteredCurrentStatus"]} at timestamp {datetime.strptime(last_job[name]["EnteredCurrentStatus"],utc_format)}')
+        logging.info(f'{name} - read ads since {last_job[name]["ClusterId"]}:{last_job[name]["EnteredCurrentStatus"]} at timestamp {datetime.utcfromtimestamp(last_job[name]["EnteredCurrentStatus"])}')
 
     for ad in generate_ads(ads):
         if last_job[name]['ClusterId'] is None:
             last_job[name]['ClusterId'] = int(ad['ClusterId'])
             last_job[name]['EnteredCurrentStatus'] = ad['EnteredCurrentStatus']
 
-        if datetime.strptime(ad['EnteredCurrentStatus'],utc_format) > datetime.strptime(last_job[name]['EnteredCurrentStatus'],utc_format):
+        if ad['EnteredCurrentStatus'] > last_job[name]['EnteredCurrentStatus']:
             last_job[name]['ClusterId'] = int(ad['ClusterId'])
             last_job[name]['EnteredCurrentStatus'] = ad['EnteredCurrentStatus']
 
         compose_ad_metrics(ad, metrics)
 
+def save_state(path, metrics, last_job):
+    """Write schedd cursors and metric values, replacing the state file at once"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'time': time.time(), 'last_job': last_job, 'metrics': metrics.snapshot()}, f)
+    os.replace(tmp, path)
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
 if __name__ == '__main__':
     parser = OptionParser('usage: %prog [options] history_files')
 
@@ -185,6 +214,16 @@ if __name__ == '__main__':
     parser.add_option('-i','--interval', default=300,
                     action='store', type='int',
                     help='collector query interval in seconds')
+    parser.add_option('--label-limit', default=[], action='append',
+                    help='label=N: keep the N values of a label with the most recent jobs, '
+                         'fold the rest into "other" (repeatable)')
+    parser.add_option('--label-half-life', default=86400,
+                    action='store', type='float',
+                    help='seconds for job counts ranking label values to halve')
+    parser.add_option('--drop-labels', default=[], action='append',
+                    help='metric=label,label: leave labels out of a metric (repeatable)')
+    parser.add_option('--state-file', default=None,
+                    help='file to keep schedd cursors and metric totals in across restarts')
     parser.add_option('--debug', default=False, action='store_true')
     (options, args) = parser.parse_args()
     if not args:
@@ -197,11 +236,24 @@ if __name__ == '__main__':
 
     logging.basicConfig(level=level, format='%(asctime)s %(levelname)s %(name)s : %(message)s')
 
-    metrics = JobMetrics()
+    try:
+        limits = {label: int(n) for label, n in (l.split('=') for l in options.label_limit)}
+        drop = {name: labels.split(',') for name, labels in (d.split('=') for d in options.drop_labels)}
+    except ValueError:
+        parser.error('bad --label-limit or --drop-labels')
+    for label in list(limits) + [l for labels in drop.values() for l in labels]:
+        if label not in JOB_LABELS:
+            parser.error(f'unknown label {label}')
+
+    metrics = JobMetrics(limits, drop, options.label_half_life)
+    for name in drop:
+        if name not in metrics.family_labels:
+            parser.error(f'unknown metric {name}')
 
     prometheus_client.REGISTRY.unregister(prometheus_client.GC_COLLECTOR)
     prometheus_client.REGISTRY.unregister(prometheus_client.PLATFORM_COLLECTOR)
     prometheus_client.REGISTRY.unregister(prometheus_client.PROCESS_COLLECTOR)
+    stage_metrics.register()
 
     prometheus_client.start_http_server(options.port)
     if options.collectors:
@@ -214,10 +266,20 @@ if __name__ == '__main__':
             logging.error(f'No schedds found')
             exit()
 
+        state = load_state(options.state_file) if options.state_file else None
+        if state:
+            logging.info(f'restoring state from {options.state_file}, saved at {datetime.fromtimestamp(state["time"])}')
+            last_job.update(state['last_job'])
+            metrics.restore(state['metrics'])
+
         while True:
             start = time.time()
             for collector in args:
                 query_collector(collector, aps,  metrics, last_job)
+            metrics.update()
+            if options.state_file:
+                save_state(options.state_file, metrics, last_job)
+            log_bad_values()
 
             delta = time.time() - start
             # sleep for interval minus scrape duration
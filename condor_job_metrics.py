@@ -1,35 +1,221 @@
-from prometheus_client import Counter, Histogram
+import math
+import time
+import logging
+from collections import defaultdict
+from prometheus_client import Counter, Gauge, Histogram
+
+JOB_LABELS = ['owner','site','schedd','GPUDeviceName','usage','kind','IceProdDataset','IceProdTaskName','MATCH_EXP_JOBGLIDEIN_ResourceName']
+
+class LabelGuard():
+    '''
+     Keep the `limit` values of one label with the most jobs recently, and
+     fold the rest into `other`. Job counts decay with `half_life` seconds.
+     Until the first `update()`, values are kept in the order they are seen.
+    '''
+
+    def __init__(self, name, limit, half_life=86400., other='other'):
+        self.name = name
+        self.limit = limit
+        self.half_life = half_life
+        self.other = other
+        self.volume = defaultdict(float)
+        self.kept = set()
+        self.last_update = time.time()
+
+    def __call__(self, value):
+        if value is None:
+            return value
+        self.volume[value] += 1
+        if value in self.kept:
+            return value
+        if len(self.kept) < self.limit:
+            self.kept.add(value)
+            return value
+        return self.other
+
+    def folded(self):
+        '''Number of values currently folded into `other`'''
+        return len(self.volume.keys() - self.kept)
+
+    def update(self, now=None):
+        '''Decay job counts and pick the values to keep from now on
+
+            Returns:
+                set: values that are no longer kept
+        '''
+        if now is None:
+            now = time.time()
+        decay = 0.5 ** ((now - self.last_update) / self.half_life)
+        self.last_update = now
+        for value in list(self.volume):
+            self.volume[value] *= decay
+            if self.volume[value] < 0.01:
+                del self.volume[value]
+        kept = set(sorted(self.volume, key=self.volume.get, reverse=True)[:self.limit])
+        dropped = self.kept - kept
+        self.kept = kept
+        return dropped
 
 class JobMetrics():
     '''
      Wrapper class for holding prometheus job metrics
+
+     Args:
+        limits (dict): label: number of values to keep, folding the rest into `other`
+        drop (dict): metric name: labels to leave out of that metric
+        half_life (float): seconds over which job counts ranking label values halve
     '''
- 
-    def __init__(self):
-  
-        labels = ['owner','site','schedd','GPUDeviceName','usage','kind','IceProdDataset','IceProdTaskName','MATCH_EXP_JOBGLIDEIN_ResourceName']
-        
+
+    def __init__(self, limits={}, drop={}, half_life=86400.):
+
+        self.guards = {label: LabelGuard(label, limit, half_life) for label, limit in limits.items()}
+        self.family_labels = {}
+
+        def labels(name):
+            self.family_labels[name] = [l for l in JOB_LABELS if l not in drop.get(name, ())]
+            return self.family_labels[name]
+
         memory_buckets = (1, 2, 3, 4, 6, 8, 12, 20, 40,float('inf'))
         resource_buckets = (1, 2, 3, 4, 8, 16, float('inf'))
+        self.buckets = {'condor_job_mem_req': memory_buckets,
+                        'condor_job_mem_used': memory_buckets,
+                        'condor_job_resource_req': resource_buckets}
 
         self.condor_job_walltime_hours = Counter(f'condor_job_walltime_hours',
                                                     'Total job hours',
-                                                    labels)
+                                                    labels('condor_job_walltime_hours'))
         self.condor_job_resource_hours = Counter(f'condor_job_resource_hours',
                                                     'Total job resource kind hours',
-                                                    labels)
+                                                    labels('condor_job_resource_hours'))
         self.condor_job_count =          Counter(f'condor_job_count',
                                                     'Total job count with good exit status',
-                                                    labels)
+                                                    labels('condor_job_count'))
         self.condor_job_mem_req =        Histogram(f'condor_job_mem_req',
                                                     'Total memory request with good exit status',
-                                                    labels,
+                                                    labels('condor_job_mem_req'),
                                                     buckets=memory_buckets)
         self.condor_job_mem_used =       Histogram(f'condor_job_mem_used',
                                                     'Total memory request with good exit status',
-                                                    labels,
+                                                    labels('condor_job_mem_used'),
                                                     buckets=memory_buckets)
         self.condor_job_resource_req =   Histogram(f'condor_job_resource_req',
                                                     'Total memory request with bad exit status',
-                                                    labels,
-                                                    buckets=resource_buckets)
\ No newline at end of file
+                                                    labels('condor_job_resource_req'),
+                                                    buckets=resource_buckets)
+        self.condor_job_metrics_folded_values = Gauge(f'condor_job_metrics_folded_values',
+                                                    'Label values folded into other by the cardinality guard',
+                                                    ['label'])
+
+    def fold(self, labels):
+        '''Fold the values of guarded labels in a dict of job labels, in place'''
+        for label, guard in self.guards.items():
+            labels[label] = guard(labels[label])
+        return labels
+
+    def child(self, name, labels):
+        '''The series of metric `name` for a dict of job labels'''
+        return getattr(self, name).labels(*[labels[l] for l in self.family_labels[name]])
+
+    def update(self):
+        '''Re-rank guarded label values, removing the series of values that
+        are folded from now on'''
+        for label, guard in self.guards.items():
+            dropped = guard.update()
+            self.condor_job_metrics_folded_values.labels(label).set(guard.folded())
+            if not dropped:
+                continue
+            logging.info('folding %d values of %s into %s', len(dropped), label, guard.other)
+            for name, names in self.family_labels.items():
+                if label not in names:
+                    continue
+                metric = getattr(self, name)
+                i = names.index(label)
+                series = {tuple(s.labels[l] for l in names)
+                          for family in metric.collect() for s in family.samples}
+                for labelvalues in series:
+                    if labelvalues[i] in dropped:
+                        metric.remove(*labelvalues)
+
+    def snapshot(self):
+        '''Cumulative values of every series and the label guard rankings,
+        to `restore()` after a restart'''
+        families = {}
+        for name, names in self.family_labels.items():
+            metric = getattr(self, name)
+            series = {}
+            for family in metric.collect():
+                for sample in family.samples:
+                    labelvalues = tuple(sample.labels[l] for l in names)
+                    if sample.name == name + '_total':
+                        series[labelvalues] = [list(labelvalues), sample.value]
+                        continue
+                    entry = series.setdefault(labelvalues, [list(labelvalues), 0., {}])
+                    if sample.name == name + '_sum':
+                        entry[1] = sample.value
+                    elif sample.name == name + '_bucket':
+                        entry[2][float(sample.labels['le'])] = sample.value
+            for entry in series.values():
+                if len(entry) == 3:
+                    # cumulative bucket samples, to counts per bucket
+                    cumulative = [entry[2][le] for le in self.buckets[name]]
+                    entry[2] = [c - p for c, p in zip(cumulative, [0.] + cumulative[:-1])]
+            families[name] = {'labels': names, 'series': list(series.values())}
+            if name in self.buckets:
+                families[name]['buckets'] = [str(le) for le in self.buckets[name]]
+        guards = {label: {'volume': dict(guard.volume), 'kept': list(guard.kept), 'last_update': guard.last_update}
+                  for label, guard in self.guards.items()}
+        return {'families': families, 'guards': guards}
+
+    def restore(self, state):
+        '''Pick up the values of a `snapshot()`'''
+        for name, family in state.get('families', {}).items():
+            if self.family_labels.get(name) != family['labels']:
+                logging.warning('not restoring %s, its labels changed', name)
+                continue
+            if name in self.buckets and family.get('buckets') != [str(le) for le in self.buckets[name]]:
+                logging.warning('not restoring %s, its buckets changed', name)
+                continue
+            metric = getattr(self, name)
+            for labelvalues, *values in family['series']:
+                child = metric.labels(*labelvalues)
+                if name in self.buckets:
+                    total, counts = values
+                    replay_histogram(child, self.buckets[name], counts, total)
+                elif values[0] > 0:
+                    child.inc(values[0])
+        for label, saved in state.get('guards', {}).items():
+            if label in self.guards:
+                guard = self.guards[label]
+                guard.volume.update(saved['volume'])
+                guard.kept = set(saved['kept'][:guard.limit])
+                guard.last_update = saved['last_update']
+
+def replay_histogram(child, buckets, counts, total):
+    '''
+     Observe values into a histogram series so it ends up with `counts`
+     observations in each of `buckets` (upper bounds), adding up to `total`.
+
+     Values in a finite bucket are spread between its bounds by the same
+     fraction, picked to match the total, or if the +Inf bucket is not
+     empty, to leave it more than its lower bound on average.
+    '''
+    lower = [min(0., buckets[0])] + list(buckets[:-1])
+    counts = [int(round(n)) for n in counts]
+    low = sum(n*lo for n, lo in zip(counts[:-1], lower))
+    width = sum(n*(le - lo) for n, lo, le in zip(counts[:-1], lower, buckets))
+    if counts[-1]:
+        fraction = (total - low - counts[-1]*lower[-1]) / width if width else 1.
+        fraction = min(.5, fraction / 2)
+    else:
+        fraction = (total - low) / width if width else 1.
+    fraction = min(1., max(0., fraction))
+    values = [lo + fraction*(le - lo) for lo, le in zip(lower[:-1], buckets[:-1])]
+    if counts[-1]:
+        values.append((total - low - fraction*width) / counts[-1])
+    else:
+        values.append(lower[-1])
+    for n, lo, value in zip(counts, lower, values):
+        # stay above the lower bound, which belongs to the bucket below
+        value = max(value, math.nextafter(lo, math.inf))
+        for _ in range(n):
+            child.observe(value)
@@ -1,5 +1,37 @@
 import re
-from prometheus_client import Gauge
+from collections import defaultdict
+import numpy as np
+from prometheus_client import Gauge, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+
+JOB_LABELS = ['schedd','group','owner','state']
+
+# name: (documentation, labels) of the gauges JobMetrics declares
+JOB_FAMILIES = {
+    'condor_jobs_walltime':             ('Total allocated CPU time from start by jobs', JOB_LABELS),
+    'condor_jobs_cputime':              ('Total observed CPU user time from jobs', JOB_LABELS),
+    'condor_jobs_wastetime':            ('Total of condor job resource attributes', JOB_LABELS),
+    'condor_jobs_cpu_request':          ('Total of condor job resource attributes', JOB_LABELS),
+    'condor_jobs_memory_request_bytes': ('Total of condor job resource attributes', JOB_LABELS),
+    'condor_jobs_memory_usage_bytes':   ('Total of condor job resource attributes', JOB_LABELS),
+    'condor_jobs_disk_request_bytes':   ('Total of condor job resource attributes', JOB_LABELS),
+    'condor_jobs_disk_usage_bytes':     ('Total of condor job resource attributes', JOB_LABELS),
+    'condor_jobs_gpu_request':          ('Total of condor job resource attributes', JOB_LABELS),
+    'condor_jobs_count':                ('Count of condor jobs resource attributes', JOB_LABELS + ['exit_code']),
+}
+
+# value columns of a JobBatch row
+JOB_COLUMNS = (
+    'condor_jobs_walltime',
+    'condor_jobs_cputime',
+    'condor_jobs_wastetime',
+    'condor_jobs_cpu_request',
+    'condor_jobs_disk_request_bytes',
+    'condor_jobs_memory_request_bytes',
+    'condor_jobs_disk_usage_bytes',
+    'condor_jobs_memory_usage_bytes',
+    'condor_jobs_gpu_request',
+)
 
 class JobMetrics():
     '''
@@ -66,4 +98,92 @@ class SlotMetrics():
     def clear(self):
         for key in self.__dict__.keys():
             if isinstance(self.__dict__[key],Gauge):
-              self.__dict__[key].clear()
\ No newline at end of file
+              self.__dict__[key].clear()
+
+class MetricsSnapshot():
+    '''
+    Gauge values of one poll, built up before they are published:
+      snapshot.inc('condor_jobs_count', ('schedd', 'group', 'owner', 'Idle', 'None'))
+    Label values must be strings, in the order of the family's labels.
+    '''
+    def __init__(self, families):
+        self.values = {name: defaultdict(float) for name in families}
+
+    def inc(self, name, labelvalues, amount=1):
+        self.values[name][labelvalues] += amount
+
+class SnapshotCollector():
+    '''
+    Serve gauges from the last published snapshot, instead of clearing and
+    refilling Gauge children while scrapes may be running. A scrape sees
+    either the previous snapshot or the new one, never one half built.
+    '''
+    def __init__(self, families, registry=REGISTRY):
+        self.families = families
+        self.snapshot = {}
+        if registry is not None:
+            registry.register(self)
+
+    def new_snapshot(self):
+        return MetricsSnapshot(self.families)
+
+    def publish(self, snapshot):
+        # replaced in one assignment, and never modified after
+        self.snapshot = {name: dict(values) for name, values in snapshot.values.items()}
+
+    def describe(self):
+        for name, (documentation, labels) in self.families.items():
+            yield GaugeMetricFamily(name, documentation, labels=labels)
+
+    def collect(self):
+        snapshot = self.snapshot
+        for name, (documentation, labels) in self.families.items():
+            family = GaugeMetricFamily(name, documentation, labels=labels)
+            for labelvalues, value in snapshot.get(name, {}).items():
+                family.add_metric(labelvalues, value)
+            yield family
+
+def factorize(keys):
+    '''
+    Code of each key, and the distinct keys in order of first appearance
+    '''
+    index = {}
+    codes = np.fromiter((index.setdefault(key, len(index)) for key in keys),
+                        dtype=np.int64, count=len(keys))
+    return codes, list(index)
+
+class JobBatch():
+    '''
+    Job ads reduced to a label tuple (in JOB_LABELS order), an exit code,
+    and a row of values (in JOB_COLUMNS order). `fill()` sums the rows per
+    label tuple in one vectorized pass, and writes each series once.
+    A value of None leaves the ad out of that metric.
+    '''
+    def __init__(self):
+        self.labels = []
+        self.exit_codes = []
+        self.rows = []
+
+    def add(self, labels, exit_code, values):
+        self.labels.append(labels)
+        self.exit_codes.append(exit_code)
+        self.rows.append(values)
+
+    def fill(self, snapshot):
+        if not self.rows:
+            return
+        codes, keys = factorize(self.labels)
+        # None becomes nan
+        values = np.array(self.rows, dtype=float).reshape(len(self.rows), len(JOB_COLUMNS))
+        present = ~np.isnan(values)
+        values[~present] = 0.
+        for i, name in enumerate(JOB_COLUMNS):
+            sums = np.bincount(codes, weights=values[:, i], minlength=len(keys))
+            seen = np.bincount(codes, weights=present[:, i], minlength=len(keys))
+            for j in np.flatnonzero(seen):
+                snapshot.inc(name, keys[j], sums[j])
+
+        exit_codes, exit_keys = factorize(self.exit_codes)
+        pairs, counts = np.unique(codes * len(exit_keys) + exit_codes, return_counts=True)
+        for pair, count in zip(pairs.tolist(), counts.tolist()):
+            snapshot.inc('condor_jobs_count', keys[pair // len(exit_keys)] + (exit_keys[pair % len(exit_keys)],), count)
@@ -24,6 +24,8 @@ parser.add_argument('--access_points', default=None,
 parser.add_argument('--client_id',help='oauth2 client id',default=None)
 parser.add_argument('--client_secret',help='oauth2 client secret',default=None)
 parser.add_argument('--token_url',help='oauth2 realm token url',default=None)
+parser.add_argument('--metrics-textfile', default=None,
+                    help='write pipeline stage metrics to this node_exporter textfile (.prom)')
 parser.add_argument("positionals", nargs='+')
 
 options = parser.parse_args()
@@ -35,9 +37,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name
 
 import htcondor2 as htcondor
 from condor_utils import *
+import stage_metrics
+from stage_metrics import StageTimer
 
 # daily index manditory
-options.indexname += '-'+now.strftime("%Y.%m.%d")
+options.indexname += '-'+datetime.utcnow().strftime("%Y.%m.%d")
 
 # key filter
 keys = {
@@ -49,15 +53,22 @@ keys = {
 }
 
 def es_generator(entries):
-    for data in entries:
-        add_classads(data)
-        data = {k:data[k] for k in keys if k in data} # do filtering
-        data['_index'] = options.indexname
-        data['_id'] = data['GlobalJobId'].replace('#','-').replace('.','-') + data['@timestamp']
-        yield data
+    now = time.time()
+    timer = StageTimer('add_classads')
+    try:
+        for data in entries:
+            with timer:
+                add_classads(data, now)
+                isoformat_dates(data)
+            data = {k:data[k] for k in keys if k in data} # do filtering
+            data['_index'] = options.indexname
+            data['_id'] = data['GlobalJobId'].replace('#','-').replace('.','-') + data['@timestamp']
+            yield data
+    finally:
+        timer.flush()
 
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from es_bulk import bulk
 from rest_tools.client import ClientCredentialsAuth
 
 prefix = 'http'
@@ -87,16 +98,18 @@ failed = False
 if options.access_points and options.collectors:
     for coll_address in options.positionals:
         try:
-            gen = es_generator(read_from_collector(coll_address, options.access_points))
+            gen = es_generator(read_from_collector(coll_address, options.access_points, projection=job_projection(iceprod_keys)))
             success, _ = es_import(gen)
+            log_bad_values()
         except htcondor.HTCondorException as e:
             failed = e
             logging.error('Condor error', exc_info=True)
 elif options.collectors:
     for coll_address in options.positionals:
         try:
-            gen = es_generator(read_from_collector(coll_address))
+            gen = es_generator(read_from_collector(coll_address, projection=job_projection(iceprod_keys)))
             success, _ = es_import(gen)
+            log_bad_values()
         except htcondor.HTCondorException as e:
             failed = e
             logging.error('Condor error', exc_info=True)
@@ -105,7 +118,11 @@ else:
         for filename in glob.iglob(path):
             gen = es_generator(read_from_file(filename))
             success, _ = es_import(gen)
+            log_bad_values()
             logging.info('finished processing %s', filename)
 
+if options.metrics_textfile:
+    stage_metrics.write_textfile(options.metrics_textfile)
+
 if failed:
     raise failed
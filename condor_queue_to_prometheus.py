@@ -10,8 +10,8 @@ from condor_utils import *
 import prometheus_client
 from condor_metrics import *
 from itertools import chain
-from datetime import datetime, timezone
-from dateutil import parser as dateparser
+import stage_metrics
+from stage_metrics import StageTimer
 
 def get_job_state(ad):
     jobstatus = None
@@ -25,19 +25,20 @@ def get_job_state(ad):
 
     return jobstatus
 
-def generate_ads(entries):
-    for data in entries:
-        add_classads(data)
-        yield data
-
-def compose_ad_metrics(ads):
+def generate_ads(entries, now):
+    timer = StageTimer('add_classads')
+    try:
+        for data in entries:
+            with timer:
+                add_classads(data, now)
+            yield data
+    finally:
+        timer.flush()
+
+def compose_ad_metrics(ads, now, batch):
     for ad in ads:
 
-        walltime = int(ad['RequestCpus']) * (datetime.now() - dateparser.parse(ad['JobCurrentStartDate'])).total_seconds()
-        labels = {key: None for key in metrics.labels}
-
-        labels['schedd'] = ad['GlobalJobId'].split('#')[0]
-        labels['state'] = get_job_state(ad)
+        walltime = int(ad['RequestCpus']) * (now - ad['JobCurrentStartDate'])
 
         try:
             acct_group = ad['AccountingGroup']
@@ -47,26 +48,25 @@ def compose_ad_metrics(ads):
 
         if group == 'Undefined': group = 'None'
 
-        labels['group'] = group
-        labels['owner'] = ad['Owner']
+        # label values in JOB_LABELS order
+        labels = (ad['GlobalJobId'].split('#')[0], group, str(ad['Owner']), str(get_job_state(ad)))
 
         try:
-            metrics.condor_jobs_cpu_request.labels(**labels).inc(float(ad['RequestCpus']))
-            metrics.condor_jobs_disk_request_bytes.labels(**labels).inc(float(ad['RequestDisk'])*1024)
-            metrics.condor_jobs_memory_request_bytes.labels(**labels).inc(float(ad['RequestMemory'])*1024*1024)
+            requests = (float(ad['RequestCpus']), float(ad['RequestDisk'])*1024, float(ad['RequestMemory'])*1024*1024)
         except Exception as e:
             logging.error(e)
-
-        metrics.condor_jobs_count.labels(**{'exit_code': ad['ExitCode'],**labels}).inc()
-        metrics.condor_jobs_cputime.labels(**labels).inc(ad['RemoteUserCpu'])
-        metrics.condor_jobs_disk_usage_bytes.labels(**labels).inc(ad['DiskUsage_RAW']*1024)
-        metrics.condor_jobs_memory_usage_bytes.labels(**labels).inc(ad['ResidentSetSize_RAW']*1024)
-        metrics.condor_jobs_walltime.labels(**labels).inc(walltime)
-        metrics.condor_jobs_wastetime.labels(**labels).inc(walltime - ad['RemoteUserCpu'])
-
-
-        if 'RequestGpus' in ad:
-            metrics.condor_jobs_gpu_request.labels(**labels).inc(ad['RequestGpus'])
+            requests = (None, None, None)
+
+        # values in JOB_COLUMNS order
+        batch.add(labels, str(ad['ExitCode']), (
+            walltime,
+            ad['RemoteUserCpu'],
+            walltime - ad['RemoteUserCpu'],
+            *requests,
+            ad['DiskUsage_RAW']*1024,
+            ad['ResidentSetSize_RAW']*1024,
+            ad.get('RequestGpus'),
+        ))
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s : %(message)s')
@@ -86,11 +86,11 @@ if __name__ == '__main__':
     if not args:
         parser.error('no condor history files or collectors')
 
-    metrics = JobMetrics()
-
     prometheus_client.REGISTRY.unregister(prometheus_client.GC_COLLECTOR)
     prometheus_client.REGISTRY.unregister(prometheus_client.PLATFORM_COLLECTOR)
     prometheus_client.REGISTRY.unregister(prometheus_client.PROCESS_COLLECTOR)
+    stage_metrics.register()
+    collector = SnapshotCollector(JOB_FAMILIES)
 
     prometheus_client.start_http_server(options.port)
 
@@ -100,26 +100,31 @@ if __name__ == '__main__':
         if options.access_points and options.collectors:
             for coll_address in args:
                 try:
-                    gens.append(read_from_collector(coll_address, options.access_points))
+                    gens.append(read_from_collector(coll_address, options.access_points, projection=job_projection()))
                 except htcondor.HTCondorException as e:
                     failed = e
                     logging.error('Condor error', exc_info=True)
         elif options.collectors:
             for coll_address in args:
                 try:
-                    gens.append(read_from_collector(coll_address))
+                    gens.append(read_from_collector(coll_address, projection=job_projection()))
                 except htcondor.HTCondorException as e:
                     failed = e
                     logging.error('Condor error', exc_info=True)
         gen = chain(*gens)
-        metrics.clear()
+        batch = JobBatch()
 
         start_compose_metrics = time.perf_counter()
-        compose_ad_metrics(generate_ads(gen))
+        compose_ad_metrics(generate_ads(gen, start), start, batch)
+        snapshot = collector.new_snapshot()
+        batch.fill(snapshot)
+        collector.publish(snapshot)
         end_compose_metrics = time.perf_counter()
 
         compose_diff = end_compose_metrics - start_compose_metrics
+        stage_metrics.record('compose_metrics', compose_diff)
         logging.info(f'Took {compose_diff} seconds to compose metrics')
+        log_bad_values()
 
         delta = time.time() - start
 
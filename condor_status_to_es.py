@@ -10,27 +10,35 @@ import os
 import re
 import textwrap
 from argparse import ArgumentParser
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 from functools import partial
+from itertools import chain
 from time import mktime
 
 import elasticsearch_dsl as edsl
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from elasticsearch.helpers import BulkIndexError
 from elasticsearch_dsl import MultiSearch, Search
-from elasticsearch.helpers import bulk, BulkIndexError
 import htcondor2 as htcondor
 from rest_tools.client import ClientCredentialsAuth
 
 from condor_utils import *
+from es_bulk import Throttle, bulk
+from es_dead_letter import DeadLetterQueue, error_counts
+import stage_metrics
+from glidein_index import GlideinIndex
+from status_updates import RESOURCES, STATUSES, ClientSideUpdates
 
 REGEX = re.compile(
     r"((?P<days>\d+?)d)?((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?"
 )
-# note different capitalization conventions for GPU and Cpu
-RESOURCES = ("GPUs", "Cpus", "Memory", "Disk")
-STATUSES = ("evicted", "removed", "finished", "failed")
 INDEX = "condor_status"
+# jobs resolved per msearch, and msearch requests in flight
+WINDOW_SIZE = 1000
+MSEARCH_CONCURRENCY = 4
+# local (name, DaemonStartTime) -> doc index, see glidein_index.py
+GLIDEIN_INDEX = None
 
 class Dry:
     """Helper class for debugging"""
@@ -64,12 +72,20 @@ def update_machines(entries):
     Generate upsert ops from machine classad dictionaries
     """
     for data in entries:
+        doc_id = "{:.0f}-{:s}".format(
+            time.mktime(data["DaemonStartTime"].timetuple()), data["Name"]
+        )
+        if GLIDEIN_INDEX:
+            GLIDEIN_INDEX.add(
+                data["Name"],
+                data["DaemonStartTime"].replace(tzinfo=timezone.utc).timestamp(),
+                doc_id,
+                INDEX,
+            )
         yield {
             "_index": INDEX,
             "_op_type": "update",
-            "_id": "{:.0f}-{:s}".format(
-                time.mktime(data["DaemonStartTime"].timetuple()), data["Name"]
-            ),
+            "_id": doc_id,
             "upsert": data,
             "script": {
                 "id": INDEX + "-update-machine",
@@ -81,50 +97,129 @@ def update_machines(entries):
         }
 
 
-def update_jobs(entries, history=False):
-    """
-    Generate updates to claims.* from job classad dictionaries
+def parent_slot_name(dynamic_slot_name):
+    parts = dynamic_slot_name.split("@")
+    match = re.match(r"(slot\d+)_\d+", parts[0])
+    if match:
+        parts[0] = match.group(1)
+    return "@".join(parts)
+
+
+def job_start_time(hit, history=False):
+    """When the job started in the slot it is being accounted to"""
+    if history or hit["JobStatus"] == 5:
+        return hit["JobCurrentStartDate"]
+    return hit["JobLastStartDate"]
+
+
+def slot_search(slot, t0, size=1, source=("nuthin",)):
+    """Glideins named `slot` that started no later than `t0`, newest first"""
+    return (
+        Search()
+        .filter("term", Name__keyword=slot)
+        .filter("range", DaemonStartTime={"lte": datetime.fromtimestamp(t0)},)
+        .sort({"DaemonStartTime": {"order": "desc"}})
+        .source(list(source))[:size]
+    )
+
+
+def sort_threshold(t0):
+    """The DaemonStartTime bound of `slot_search`, in the epoch millis ES sorts by.
+
+    The bound is sent as a naive local datetime, which ES reads as UTC.
     """
+    return datetime.fromtimestamp(t0).replace(tzinfo=timezone.utc).timestamp() * 1000
 
-    def parent_slot_name(dynamic_slot_name):
-        parts = dynamic_slot_name.split("@")
-        match = re.match(r"(slot\d+)_\d+", parts[0])
-        if match:
-            parts[0] = match.group(1)
-        return "@".join(parts)
 
-    # MultiSearch will fail if there are no queries to run
-    jobs = list(entries)
-    if not jobs:
-        return
+# DaemonStartTime history fetched for slots with several jobs
+SLOT_HISTORY_SIZE = 100
 
-    # glidein names are not necessarily unique on long time scales. look up the
-    # last glidein that started with the advertised name _before_ the evicted
-    # job was started
-    ms = MultiSearch(using=es, index=INDEX)
+
+def match_jobs(jobs, history=False):
+    """
+    Find the glidein each job ran in.
+
+    Glidein names are not necessarily unique on long time scales, so this
+    looks up the last glidein that started with the advertised name
+    _before_ the job was started. Jobs are first looked up in GLIDEIN_INDEX,
+    if there is one. The rest are looked up in ES, querying each slot once:
+    for a single job directly, and for several jobs by fetching the slot's
+    recent DaemonStartTime history and matching start times here. Jobs
+    older than that history are looked up individually.
+
+    Yields (job, glidein index, glidein doc id) tuples.
+    """
+    slots = defaultdict(list)
     for hit in jobs:
         try:
-            if history:
-                t0 = hit["JobCurrentStartDate"]
-            else:
-                if hit["JobStatus"] == 5:
-                    t0 = hit["JobCurrentStartDate"]
-                else:
-                    t0 = hit["JobLastStartDate"]
-            ms = ms.add(
-                Search()
-                .filter("term", Name__keyword=parent_slot_name(hit["LastRemoteHost"]))
-                .filter("range", DaemonStartTime={"lte": datetime.fromtimestamp(t0)},)
-                .sort({"DaemonStartTime": {"order": "desc"}})
-                .source(["nuthin"])[:1]
-            )
+            slot = parent_slot_name(hit["LastRemoteHost"])
+            t0 = job_start_time(hit, history)
+            if GLIDEIN_INDEX:
+                found = GLIDEIN_INDEX.lookup(slot, sort_threshold(t0) / 1000)
+                if found:
+                    yield (hit,) + found
+                    continue
+            slots[slot].append((hit, t0))
         except Exception:
             logging.warning('failed to process job, %r', hit)
-            continue
 
-    for hit, match in zip(jobs, ms.execute()):
-        if not match.hits:
+    searches = []
+    for slot, slot_jobs in slots.items():
+        if len(slot_jobs) == 1:
+            searches.append((slot_jobs, slot_search(slot, slot_jobs[0][1])))
+        else:
+            t0 = max(t0 for _, t0 in slot_jobs)
+            searches.append((slot_jobs, slot_search(slot, t0, SLOT_HISTORY_SIZE, ["DaemonStartTime"])))
+
+    unresolved = []
+    for (slot_jobs, search), response in zip(searches, multi_search([search for _, search in searches])):
+        if len(slot_jobs) == 1:
+            if response.hits:
+                yield slot_jobs[0][0], response.hits[0].meta.index, response.hits[0].meta.id
             continue
+        starts = [(match.meta.sort[0], match) for match in response.hits]
+        for hit, t0 in slot_jobs:
+            threshold = sort_threshold(t0)
+            match = next((match for start, match in starts if start <= threshold), None)
+            if match is not None:
+                yield hit, match.meta.index, match.meta.id
+            elif len(starts) == SLOT_HISTORY_SIZE:
+                unresolved.append((hit, t0))
+
+    if unresolved:
+        searches = [slot_search(parent_slot_name(hit["LastRemoteHost"]), t0) for hit, t0 in unresolved]
+        for (hit, _), response in zip(unresolved, multi_search(searches)):
+            if response.hits:
+                yield hit, response.hits[0].meta.index, response.hits[0].meta.id
+
+
+def multi_search(searches):
+    """Run searches as one MultiSearch, returning their responses in order"""
+    searches = list(searches)
+    # MultiSearch will fail if there are no queries to run
+    if not searches:
+        return []
+    ms = MultiSearch(using=es, index=INDEX)
+    for search in searches:
+        ms = ms.add(search)
+    return ms.execute()
+
+
+def update_jobs(entries, history=False):
+    """
+    Generate updates to claims.* from job classad dictionaries
+
+    Jobs are matched to glideins in windows of WINDOW_SIZE, with up to
+    MSEARCH_CONCURRENCY windows in flight, and updates are yielded as
+    each window resolves.
+    """
+    windows = map_windows(
+        lambda jobs: list(match_jobs(jobs, history)),
+        entries,
+        size=WINDOW_SIZE,
+        concurrency=MSEARCH_CONCURRENCY,
+    )
+    for hit, index, doc_id in chain.from_iterable(windows):
         if history:
             if hit["JobStatus"] == 3:
                 category = "removed"
@@ -154,8 +249,8 @@ def update_jobs(entries, history=False):
 
         doc = {
             "_op_type": "update",
-            "_index": match.hits[0].meta.index,
-            "_id": match.hits[0].meta.id,
+            "_index": index,
+            "_id": doc_id,
             "script": {
                 "id": INDEX + "-update-jobs",
                 "params": {
@@ -168,13 +263,23 @@ def update_jobs(entries, history=False):
         yield doc
 
 @Dry
-def es_import(gen, es):
+def es_import(gen, es, dead_letter=None):
+    """Returns the number of docs indexed, or None if any failed.
+
+    One bulk request is sent at a time: the scripted updates of a run hit
+    the same glidein docs many times, and would conflict with each other in
+    concurrent requests, as would client-side updates overwrite each other.
+    """
+    throttle = Throttle(concurrency=1, max_concurrency=1)
     try:
-        success, _ = bulk(es, gen, max_retries=20, initial_backoff=2, max_backoff=3600)
+        success, failed = bulk(es, gen, max_retries=20, initial_backoff=2, max_backoff=3600,
+                               dead_letter=dead_letter, stats_only=True, throttle=throttle)
+        if failed:
+            logging.error("%d actions failed, see the dead letter queue", failed)
+            return None
         return success
     except BulkIndexError as e:
-        for error in e.errors:
-            logging.info(json.dumps(error, indent=2, default=str))
+        logging.error("%d actions failed: %s", len(e.errors), dict(error_counts(e.errors)))
 
 
 def put_scripts(es, index):
@@ -320,10 +425,53 @@ if __name__ == "__main__":
     parser.add_argument('--client_secret',help='oauth2 client secret',default=None)
     parser.add_argument('--token_url',help='oauth2 realm token url',default=None)
     parser.add_argument('--token',help='oauth2 token',default=None)
+    parser.add_argument(
+        "--dead-letter",
+        default=None,
+        help="directory to keep rejected actions in, for replay with es_dead_letter.py",
+    )
+    parser.add_argument(
+        "--metrics-textfile",
+        default=None,
+        help="write pipeline stage metrics to this node_exporter textfile (.prom)",
+    )
+    parser.add_argument(
+        "--window-size",
+        default=WINDOW_SIZE,
+        type=int,
+        help="jobs matched to glideins per msearch request",
+    )
+    parser.add_argument(
+        "--msearch-concurrency",
+        default=MSEARCH_CONCURRENCY,
+        type=int,
+        help="msearch requests in flight while matching jobs to glideins",
+    )
+    parser.add_argument(
+        "--glidein-index",
+        default=None,
+        help="sqlite file indexing glidein docs, to match jobs without searching ES",
+    )
+    parser.add_argument(
+        "--glidein-index-retention",
+        default=timedelta(days=30),
+        type=parse_time,
+        help="how long to keep glideins in the index (default 30d)",
+    )
+    parser.add_argument(
+        "--client-side-updates",
+        default=False,
+        action="store_true",
+        help="apply the update scripts here and send plain doc updates",
+    )
     parser.add_argument("collectors", nargs="+")
     options = parser.parse_args()
 
     INDEX = options.indexname
+    WINDOW_SIZE = options.window_size
+    MSEARCH_CONCURRENCY = options.msearch_concurrency
+    if options.glidein_index:
+        GLIDEIN_INDEX = GlideinIndex(options.glidein_index)
 
     Dry._dryrun  = options.dry_run
 
@@ -361,13 +509,26 @@ if __name__ == "__main__":
     if options.put_script:
         put_scripts(options.index)
 
+    dead_letter = DeadLetterQueue(options.dead_letter) if options.dead_letter else None
+
     failed = False
     for coll_address in options.collectors:
         try:
+            queried = datetime.now()
+            machines_after = queried - options.after
             gen = update_machines(
-                read_status_from_collector(coll_address, datetime.now() - options.after)
+                read_status_from_collector(coll_address, machines_after)
             )
-            success = es_import(gen, es)
+            if options.client_side_updates:
+                gen = ClientSideUpdates(es).convert(gen)
+            success = es_import(gen, es, dead_letter)
+            if GLIDEIN_INDEX and not options.dry_run:
+                if success is None:
+                    # some glidein docs may not exist
+                    GLIDEIN_INDEX.discard()
+                else:
+                    GLIDEIN_INDEX.commit(time.mktime(machines_after.timetuple()),
+                                         time.mktime(queried.timetuple()))
 
             # Update claims from evicted and held jobs
             after = time.mktime((datetime.now() - timedelta(minutes=10)).timetuple())
@@ -392,7 +553,9 @@ if __name__ == "__main__":
                 ),
                 history=False,
             )
-            success = es_import(gen, es)
+            if options.client_side_updates:
+                gen = ClientSideUpdates(es).convert(gen)
+            success = es_import(gen, es, dead_letter)
 
             # Update claims from finished jobs
             gen = update_jobs(
@@ -414,11 +577,23 @@ if __name__ == "__main__":
                 ),
                 history=True,
             )
-            success = es_import(gen, es)
+            if options.client_side_updates:
+                gen = ClientSideUpdates(es).convert(gen)
+            success = es_import(gen, es, dead_letter)
 
         except htcondor.HTCondorException as e:
             failed = e
             logging.error('Condor error', exc_info=True)
 
+    if dead_letter:
+        dead_letter.close()
+
+    if GLIDEIN_INDEX:
+        GLIDEIN_INDEX.prune(options.glidein_index_retention.total_seconds())
+        GLIDEIN_INDEX.close()
+
+    if options.metrics_textfile:
+        stage_metrics.write_textfile(options.metrics_textfile)
+
     if failed:
         raise failed
@@ -10,6 +10,8 @@ from condor_utils import *
 import prometheus_client
 from condor_metrics import *
 from itertools import chain
+import stage_metrics
+from stage_metrics import StageTimer
 
 def get_job_state(ad):
     jobstatus = None
@@ -24,17 +26,18 @@ def get_job_state(ad):
     return jobstatus
 
 def generate_ads(entries):
-    for data in entries:
-        add_classads(data)
-        yield data
-
-def compose_ad_metrics(ads):
+    now = time.time()
+    timer = StageTimer('add_classads')
+    try:
+        for data in entries:
+            with timer:
+                add_classads(data, now)
+            yield data
+    finally:
+        timer.flush()
+
+def compose_ad_metrics(ads, batch):
     for ad in ads:
-        labels = {key: None for key in metrics.labels}
-
-        labels['schedd'] = ad['GlobalJobId'].split('#')[0]
-        labels['state'] = get_job_state(ad)
-
         try:
             acct_group = ad['AccountingGroup']
             group = acct_group.split('.')[0]
@@ -43,21 +46,22 @@ def compose_ad_metrics(ads):
 
         if group == 'Undefined': group = 'None'
 
-        labels['group'] = group
-        labels['owner'] = ad['Owner']
-
-        metrics.condor_jobs_count.labels(**{'exit_code': ad['ExitCode'],**labels}).inc()
-        metrics.condor_jobs_cpu_request.labels(**labels).inc(ad['RequestCpus'])
-        metrics.condor_jobs_cputime.labels(**labels).inc(ad['RemoteUserCpu'])
-        metrics.condor_jobs_disk_request_bytes.labels(**labels).inc(ad['RequestDisk']*1024)
-        metrics.condor_jobs_disk_usage_bytes.labels(**labels).inc(ad['DiskUsage_RAW']*1024)
-        metrics.condor_jobs_memory_request_bytes.labels(**labels).inc(ad['RequestMemory']*1024*1024)
-        metrics.condor_jobs_memory_usage_bytes.labels(**labels).inc(ad['ResidentSetSize_RAW']*1024)
-        metrics.condor_jobs_walltime.labels(**labels).inc(ad['walltimehrs']*3600)
-        metrics.condor_jobs_wastetime.labels(**labels).inc((ad['walltimehrs']*3600)-ad['RemoteUserCpu'])
-
-        if 'RequestGpus' in ad:
-            metrics.condor_jobs_gpu_request.labels(**labels).inc(ad['RequestGpus'])
+        # label values in JOB_LABELS order
+        labels = (ad['GlobalJobId'].split('#')[0], group, str(ad['Owner']), str(get_job_state(ad)))
+        walltime = ad['walltimehrs']*3600
+
+        # values in JOB_COLUMNS order
+        batch.add(labels, str(ad['ExitCode']), (
+            walltime,
+            ad['RemoteUserCpu'],
+            walltime - ad['RemoteUserCpu'],
+            ad['RequestCpus'],
+            ad['RequestDisk']*1024,
+            ad['RequestMemory']*1024*1024,
+            ad['DiskUsage_RAW']*1024,
+            ad['ResidentSetSize_RAW']*1024,
+            ad.get('RequestGpus'),
+        ))
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s : %(message)s')
@@ -77,11 +81,11 @@ if __name__ == '__main__':
     if not args:
         parser.error('no condor history files or collectors')
 
-    metrics = JobMetrics()
-
     prometheus_client.REGISTRY.unregister(prometheus_client.GC_COLLECTOR)
     prometheus_client.REGISTRY.unregister(prometheus_client.PLATFORM_COLLECTOR)
     prometheus_client.REGISTRY.unregister(prometheus_client.PROCESS_COLLECTOR)
+    stage_metrics.register()
+    collector = SnapshotCollector(JOB_FAMILIES)
 
     prometheus_client.start_http_server(options.port)
 
@@ -91,13 +95,16 @@ if __name__ == '__main__':
             start = time.time()
             for coll_address in args:
                 try:
-                    gens.append(read_from_collector(coll_address))
+                    gens.append(read_from_collector(coll_address, projection=job_projection()))
                 except htcondor.HTCondorException as e:
                     failed = e
                     logging.error('Condor error', exc_info=True)
             gen = chain(*gens)
-            metrics.slot_metrics.clear()
-            compose_ad_metrics(generate_ads(gen))
+            batch = JobBatch()
+            compose_ad_metrics(generate_ads(gen), batch)
+            snapshot = collector.new_snapshot()
+            batch.fill(snapshot)
+            collector.publish(snapshot)
             delta = time.time() - start
             
             if delta < options.interval:
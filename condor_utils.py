@@ -5,18 +5,30 @@ import gzip
 from optparse import OptionParser
 from datetime import datetime,timedelta
 import time
+import calendar
 import logging
-from collections import OrderedDict
+from collections import OrderedDict, Counter, deque
 try:
     from collections.abc import Sequence
 except ImportError:
     from collections import Sequence
 import re
+import queue
+import ipaddress
+import threading
+from functools import partial, lru_cache
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 import classad2 as classad
 
-now = datetime.utcnow()
-zero = datetime.utcfromtimestamp(0).isoformat()
+from stage_metrics import stage, StageTimer, timed_schedd
+
+# Dates are kept as epoch seconds until they are sent to ES (see
+# `isoformat_dates`). NOW as a default stands for the time the batch
+# of ads is being processed.
+NOW = object()
+zero = 0.
 
 good_keys = {
     'JobStatus':0.,
@@ -44,13 +56,13 @@ good_keys = {
     'ExitStatus':0.,
     'CumulativeSlotTime':0.,
     'LastRemoteHost':'',
-    'QDate':now,
-    'JobStartDate':now,
-    'JobCurrentStartDate':now,
-    'EnteredCurrentStatus':now,
+    'QDate':NOW,
+    'JobStartDate':NOW,
+    'JobCurrentStartDate':NOW,
+    'EnteredCurrentStatus':NOW,
     'RemoteUserCpu':0.,
     'RemoteSysCpu':0.,
-    'CompletionDate':now,
+    'CompletionDate':NOW,
     'CommittedTime':0.,
     'RemoteWallClockTime':0.,
     'MATCH_EXP_JOBGLIDEIN_ResourceName':'other',
@@ -76,6 +88,22 @@ good_keys = {
 
 site_key = 'MATCH_EXP_JOBGLIDEIN_ResourceName'
 
+# IceProd attributes worth keeping; filter_keys keeps any IceProd* attribute,
+# but schedd projections cannot match on a prefix
+iceprod_keys = [
+    'IceProdDataset', 'IceProdDatasetId', 'IceProdJobId', 'IceProdJobIndex',
+    'IceProdTaskId', 'IceProdTaskIndex', 'IceProdTaskName',
+]
+
+def job_projection(extra=()):
+    """Attributes to ask schedds for, for job ads that go through `add_classads`.
+
+    Everything `add_classads` and `normalize_gpu` read is in `good_keys`
+    (projections are case-insensitive, so `Requestgpus` also covers
+    `RequestGPUs`), plus any script-specific `extra` attributes.
+    """
+    return sorted(set(good_keys).union(extra))
+
 key_types = {
     'number': ['AutoClusterId','BlockReadBytes','BlockReadKbytes','BlockReads',
                'BlockWriteBytes','BlockWriteKbytes','BufferBlockSize','BufferSize',
@@ -187,8 +215,11 @@ reserved_ips = {
     '206.12': 'CA-MCGILL-CLUMEQ-T2',
     '216.47': 'MWT2',
 }
-reserved_ips.update({'10.%d'%i:None for i in range(256)})
-reserved_ips.update({'172.%d'%i:None for i in range(16,32)})
+# keys are either the first two octets of a /16, or CIDR networks
+reserved_ips.update({
+    '10.0.0.0/8': None,
+    '172.16.0.0/12': None,
+})
 
 reserved_domains = {
     'aglt2.org': 'AGLT2',
@@ -386,30 +417,93 @@ def get_site_from_resource(resource):
     else:
         return 'other'
 
+class SiteResolver:
+    """Resolve resource names, hostnames and IPs to sites.
+
+    Hostnames are matched on their longest known domain suffix, using a
+    trie of reversed domain labels. IPs are matched on their longest
+    known network prefix, so ranges need not be /16s.
+
+    Args:
+        domains (dict): domain suffix: resource name
+        ip_ranges (dict): network: resource name (None for private ranges)
+        cache_size (int): number of `resolve` results to remember
+    """
+    _site = object()  # trie node key for the resource of a suffix
+
+    def __init__(self, domains=reserved_domains, ip_ranges=reserved_ips, cache_size=65536):
+        self.domains = {}
+        for domain, resource in domains.items():
+            node = self.domains
+            for label in reversed(domain.lower().split('.')):
+                node = node.setdefault(label, {})
+            node[self._site] = resource
+
+        networks = {}
+        for network, resource in ip_ranges.items():
+            if '/' not in network:
+                parts = network.split('.')
+                network = '.'.join(parts + ['0']*(4-len(parts))) + '/' + str(8*len(parts))
+            network = ipaddress.IPv4Network(network)
+            networks.setdefault(network.prefixlen, {})[int(network.network_address) >> (32-network.prefixlen)] = resource
+        self.networks = sorted(networks.items(), reverse=True)
+
+        self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+    def _resource_to_site(self, resource):
+        if resource:
+            site = get_site_from_resource(resource)
+            if site != 'other':
+                return site
+        return resource
+
+    def from_domain(self, hostname):
+        node = self.domains
+        resource = None
+        for label in reversed(hostname.lower().split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            resource = node.get(self._site, resource)
+        return self._resource_to_site(resource)
+
+    def from_ip(self, ip):
+        parts = ip.split('.')
+        if len(parts) != 4 or not all(p.isdigit() for p in parts):
+            return None
+        addr = 0
+        for p in parts:
+            addr = (addr << 8) | int(p)
+        for prefixlen, networks in self.networks:
+            key = addr >> (32-prefixlen)
+            if key in networks:
+                return self._resource_to_site(networks[key])
+        return None
+
+    def _resolve(self, resource, host, ip):
+        """Get the site of a job or slot.
+
+        Memoized as `resolve`, since the same glideins show up in many ads.
+
+        Args:
+            resource (str): resource name, or None if it does not name a site
+            host (str): hostname of the execute node
+            ip (str): IP address of the execute node
+
+        Returns:
+            str: site name, or 'other'
+        """
+        if resource is not None:
+            return get_site_from_resource(resource)
+        return self.from_domain(host) or self.from_ip(ip) or 'other'
+
+site_resolver = SiteResolver()
+
 def get_site_from_domain(hostname):
-    parts = hostname.lower().split('.')
-    ret = None
-    if '.'.join(parts[-3:]) in reserved_domains:
-        ret = reserved_domains['.'.join(parts[-3:])]
-    elif '.'.join(parts[-2:]) in reserved_domains:
-        ret = reserved_domains['.'.join(parts[-2:])]
-    if ret:
-        ret2 = get_site_from_resource(ret)
-        if ret2 != 'other':
-            return ret2
-    return ret
+    return site_resolver.from_domain(hostname)
 
 def get_site_from_ip_range(ip):
-    parts = ip.split('.')
-    ret = None
-    if len(parts) == 4 and all(p.isdigit() for p in parts):
-        if '.'.join(parts[:2]) in reserved_ips:
-            ret = reserved_ips['.'.join(parts[:2])]
-    if ret:
-        ret2 = get_site_from_resource(ret)
-        if ret2 != 'other':
-            return ret2
-    return ret
+    return site_resolver.from_ip(ip)
 
 def is_bad_site(data, site_key='MATCH_EXP_JOBGLIDEIN_ResourceName'):
     bad_sites = ('other','osgconnect','xsede-osg','WIPAC','wipac', 'Undefined', 'undefined')
@@ -492,6 +586,87 @@ gpu_ns_photon = OrderedDict([
     ('quadro rtx 8000', 3.74),
 ])
 
+# GPU models assumed for sites and hosts that do not report a GPU name.
+# For site resources (lower case), `==` rules match the whole name and `in`
+# rules match anywhere in it; rules are tried in order.
+site_resource_gpus = [
+    ('==', 'crane', 'k20'), # Nebraska has k20
+    ('in', 'su-its', '750 ti'), # SU has 750 ti
+    ('==', 'sdsccompinfrastructure', '1080 ti'), # likely to be 1080 ti (~95% odds)
+    ('==', 'sdsc-prp', '1080 ti'), # likely to be 1080 ti (~95% odds)
+    ('==', 'ucsdt2', ('k80', 'p100')), # comet has k80 and p100
+    ('in', 'su-og', '750 ti'), # SU has 750 ti
+    ('in', 'aachen', 'p100'), # now has p100
+    ('in', 't2b_be_iihe', 'm2075'), # Tesla M2075
+]
+glidein_site_resource_gpus = {
+    'umd': '1080', # UMD has 1080
+    'msu': 'k40', # the older msu cluster, k40
+}
+host_suffix_gpus = [
+    ('crane.hcc.unl.edu', 'k20'), # Nebraska has k20
+    ('syr.edu', '750 ti'), # SU has 750 ti
+]
+
+def _first_match_re(patterns):
+    """Compile patterns into one regex whose match has `lastindex` set to
+    the (1-based) position of the first pattern that matches, in list order.
+    """
+    return re.compile('|'.join('(?:{})'.format(p) for p in patterns))
+
+# '.*?(name)' tried in table order finds the first model (not the leftmost
+# one) in the name, so e.g. '1080 ti' wins over '1080'
+_gpu_models = list(gpu_ns_photon)
+_gpu_model_re = _first_match_re('.*?({})'.format(re.escape(name)) for name in _gpu_models)
+_site_resource_gpu_re = _first_match_re(
+    ('({})\\Z' if op == '==' else '.*?({})').format(re.escape(name))
+    for op, name, _ in site_resource_gpus
+)
+
+def _is_icecube_1080_host(host):
+    if 'rad' in host:
+        return True
+    if 'gtx' in host:
+        try:
+            return int(host.split('gtx-',1)[-1].split('.',1)[0]) < 10
+        except ValueError:
+            pass
+    return False
+
+@lru_cache(maxsize=4096)
+def match_gpu_model(gpu_name, site_resource, glidein_site_resource, host):
+    """Find the GPU model(s) for a job or slot, for looking up in `gpu_ns_photon`.
+
+    Args:
+        gpu_name (str): reported GPU name(s), comma separated
+        site_resource (str): resource name of the glidein
+        glidein_site_resource (str): GLIDEIN_SiteResource of the glidein
+        host (str): hostname of the execute node
+
+    Returns:
+        str or tuple: GPU model(s), or None if unknown
+    """
+    if gpu_name is not None:
+        m = _gpu_model_re.match(gpu_name.split(',')[0].lower())
+        if m:
+            return _gpu_models[m.lastindex-1]
+    if site_resource is not None:
+        m = _site_resource_gpu_re.match(site_resource.lower())
+        if m:
+            return site_resource_gpus[m.lastindex-1][2]
+    if glidein_site_resource is not None:
+        model = glidein_site_resource_gpus.get(glidein_site_resource.lower())
+        if model:
+            return model
+    if host is not None:
+        host = host.lower()
+        if host.endswith('.icecube.wisc.edu'):
+            return '1080' if _is_icecube_1080_host(host) else '980'
+        for suffix, model in host_suffix_gpus:
+            if host.endswith(suffix):
+                return model
+    return None
+
 def normalize_gpu(job, key='gpuhrs',
     site_key='MATCH_EXP_JOBGLIDEIN_ResourceName',
     gpunames_key=None,
@@ -554,65 +729,15 @@ def normalize_gpu(job, key='gpuhrs',
     if job.get(gpu_ns_per_photon_key, 0) > 0.:
         normalize_gpuhrs(job)
         return
-    if gpunames_key in job:
-        # glidein reported gpu name, try to find a match
-        gpu_name = job[gpunames_key].split(',')[0].lower()
-        for name in gpu_ns_photon:
-            if name in gpu_name:
-                normalize_gpuhrs(job, gpu_identifier=name)
-                return
-    if site_key in job:
-        site_resource = job[site_key].lower()
-        if site_resource == 'crane': # Nebraska has k20
-            normalize_gpuhrs(job, gpu_identifier='k20')
-            return
-        elif 'su-its' in site_resource: # SU has 750 ti
-            normalize_gpuhrs(job, gpu_identifier='750 ti')
-            return
-        elif site_resource == 'sdsccompinfrastructure': # likely to be 1080 ti (~95% odds)
-            normalize_gpuhrs(job, gpu_identifier='1080 ti')
-            return
-        elif site_resource == 'sdsc-prp': # likely to be 1080 ti (~95% odds)
-            normalize_gpuhrs(job, gpu_identifier='1080 ti')
-            return
-        elif site_resource == 'ucsdt2': # comet has k80 and p100
-            normalize_gpuhrs(job, gpu_identifier=['k80', 'p100'])
-            return
-        elif 'su-og' in site_resource: # SU has 750 ti
-            normalize_gpuhrs(job, gpu_identifier='750 ti')
-            return
-        elif 'aachen' in site_resource: # now has p100
-            normalize_gpuhrs(job, gpu_identifier='p100')
-            return
-        elif 't2b_be_iihe' in site_resource: # Tesla M2075
-            normalize_gpuhrs(job, gpu_identifier='m2075')
-            return
-    if 'MachineAttrGLIDEIN_SiteResource0' in job:
-        site_resource = job['MachineAttrGLIDEIN_SiteResource0'].lower()
-        if site_resource == 'umd': # UMD has 1080
-            normalize_gpuhrs(job, gpu_identifier='1080')
-            return
-        elif site_resource == 'msu': # the older msu cluster, k40
-            normalize_gpuhrs(job, gpu_identifier='k40')
-            return
-    if 'LastRemoteHost' in job:
-        host = job['LastRemoteHost'].lower()
-        if host.endswith('.icecube.wisc.edu'):
-            if 'rad' in host or ('gtx' in host and int(host.split('gtx-',1)[-1].split('.',1)[0]) < 10):
-                # this is a 1080
-                normalize_gpuhrs(job, gpu_identifier='1080')
-                return
-            else:
-                # this is a 980
-                normalize_gpuhrs(job, gpu_identifier='980')
-                return
-        elif host.endswith('crane.hcc.unl.edu'):
-            # Nebraska has k20
-            normalize_gpuhrs(job, gpu_identifier='k20')
-            return
-        elif host.endswith('syr.edu'): # SU has 750 ti
-            normalize_gpuhrs(job, gpu_identifier='750 ti')
-            return
+    gpu_identifier = match_gpu_model(
+        job[gpunames_key] if gpunames_key in job else None,
+        job.get(site_key),
+        job.get('MachineAttrGLIDEIN_SiteResource0'),
+        job.get('LastRemoteHost'),
+    )
+    if gpu_identifier is not None:
+        normalize_gpuhrs(job, gpu_identifier=gpu_identifier)
+        return
 
     job[nonnorm_key] = job[raw_key]
 
@@ -622,66 +747,139 @@ def date_from_string(s):
     else:
         return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S')
 
-def filter_keys(data):
-    # RequestGPUs comes in many cases
+def _to_float(value):
+    if value == classad.Value.Undefined:
+        return value
+    return float(value)
+
+def _to_epoch(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond/1e6
+    value = float(value)
+    # raises for NaN and dates `isoformat_dates` could not format
+    datetime.utcfromtimestamp(value)
+    return value
+
+def compile_coercion_plan(keys):
+    """Turn a dict of attribute defaults into a list of converters.
+
+    The type of each default decides how values are converted; a default
+    of NOW marks a date, kept as epoch seconds.
+
+    Returns:
+        list: (key, kind, converter, default, fallback) tuples, where
+              default is used for missing values and fallback for values
+              that cannot be converted
+    """
+    plan = []
+    for k, default in keys.items():
+        if default is NOW:
+            plan.append((k, 'date', _to_epoch, NOW, zero))
+        elif isinstance(default, bool):
+            plan.append((k, 'bool', bool, default, default))
+        elif isinstance(default, (float, int)):
+            plan.append((k, 'float/int', _to_float, float(default), default))
+        else:
+            plan.append((k, 'str', str, str(default), str(default)))
+    return plan
+
+coercion_plan = compile_coercion_plan(good_keys)
+
+# what filter_keys does with each attribute name it has seen:
+# True to keep, False to drop, None to fold into Requestgpus
+_key_actions = {}
+
+def _key_action(k):
+    if k in good_keys:
+        action = True
+    elif k.lower() == 'requestgpus':
+        # RequestGPUs comes in many cases
+        action = None
+    else:
+        action = 'IceProd' in k and not k.endswith('InstanceId')
+    _key_actions[k] = action
+    return action
+
+# counts of values filter_keys could not convert, by (kind, key)
+bad_values = Counter()
+
+def log_bad_values():
+    """Log (and reset) counts of values `filter_keys` could not convert"""
+    for (kind, k), count in sorted(bad_values.items()):
+        logging.info('%d bad %s values for %s', count, kind, k)
+    bad_values.clear()
+
+def filter_keys(data, now=None):
+    """Keep only `good_keys` (and IceProd attributes), converting values to
+    the type of their defaults and filling in missing ones.
+
+    Args:
+        data (dict): a classad dict for a single job
+        now (float): epoch time to use for missing dates (default: current time)
+    """
+    if now is None:
+        now = time.time()
     for k in list(data):
-        if k.lower() == 'requestgpus' and k != 'Requestgpus':
-            data['Requestgpus'] = data[k]
+        try:
+            action = _key_actions[k]
+        except KeyError:
+            action = _key_action(k)
+        if action is None:
+            data['Requestgpus'] = data.pop(k)
+        elif not action:
             del data[k]
 
-    for k in list(data.keys()):
-        if not (k in good_keys or ('IceProd' in k and not k.endswith('InstanceId'))):
-            del data[k]
-    for k in good_keys:
-        if k not in data:
-            data[k] = good_keys[k]
-        if isinstance(good_keys[k],bool):
+    for k, kind, convert, default, fallback in coercion_plan:
+        if k in data:
             try:
-                data[k] = bool(data[k])
-            except:
-                logging.info('bad bool [%s]: %r', k, data[k], exc_info=True)
-                data[k] = good_keys[k]
-        elif isinstance(good_keys[k],(float,int)):
-            if data[k] != classad.Value.Undefined:
-                try:
-                    data[k] = float(data[k])
-                except:
-                    logging.info('bad float/int [%s]: %r', k, data[k], exc_info=True)
-                    data[k] = good_keys[k]
-        elif isinstance(good_keys[k],datetime):
-            if isinstance(data[k], datetime):
-                data[k] = data[k].isoformat()
-            else:
-                try:
-                    data[k] = datetime.utcfromtimestamp(data[k]).isoformat()
-                except:
-                    logging.info('bad date [%s]: %r', k, data[k], exc_info=True)
-                    data[k] = zero
+                data[k] = convert(data[k])
+            except Exception:
+                if not bad_values[kind, k]:
+                    logging.info('bad %s [%s]: %r', kind, k, data[k])
+                bad_values[kind, k] += 1
+                data[k] = fallback
         else:
-            data[k] = str(data[k])
+            data[k] = now if default is NOW else default
+
+# every date attribute, as epoch seconds until `isoformat_dates`
+date_keys = [k for k, kind, _, _, _ in coercion_plan if kind == 'date'] + ['@timestamp', 'date']
+
+def isoformat_dates(data):
+    """Convert the epoch dates of a job from `add_classads` to ISO strings, for ES"""
+    for k in date_keys:
+        if k in data:
+            data[k] = datetime.utcfromtimestamp(data[k]).isoformat()
+
+# Illume jobs were reported as MSU for a while
+illume_msu_mixup = (calendar.timegm((2018, 12, 1, 0, 0, 0)), calendar.timegm((2019, 3, 30, 0, 0, 0)))
 
-def add_classads(data):
+def add_classads(data, now=None):
     """Add extra classads to a condor job
 
+    Dates (including the added `@timestamp` and `date`) are epoch seconds;
+    use `isoformat_dates` before sending the job to ES.
+
     Args:
         data (dict): a classad dict for a single job
+        now (float): epoch time the batch of jobs is processed at (default: current time)
     """
-    filter_keys(data)
+    if now is None:
+        now = time.time()
+    filter_keys(data, now)
 
-    data['@timestamp'] = datetime.utcnow().isoformat()
+    data['@timestamp'] = now
     # add completion date
-    if data['CompletionDate'] != zero and data['CompletionDate']:
+    if data['CompletionDate']:
         data['date'] = data['CompletionDate']
-    elif data['EnteredCurrentStatus'] != zero and data['EnteredCurrentStatus']:
+    elif data['EnteredCurrentStatus']:
         data['date'] = data['EnteredCurrentStatus']
     else:
-        data['date'] = datetime.utcnow().isoformat()
+        data['date'] = now
     # add queued time
-    if data['JobCurrentStartDate'] != zero and data['JobCurrentStartDate']:
-        data['queue_time'] = date_from_string(data['JobCurrentStartDate']) - date_from_string(data['QDate'])
+    if data['JobCurrentStartDate']:
+        data['queue_time'] = (data['JobCurrentStartDate'] - data['QDate'])/3600.
     else:
-        data['queue_time'] = datetime.now() - date_from_string(data['QDate'])
-    data['queue_time'] = data['queue_time'].total_seconds()/3600.
+        data['queue_time'] = (now - data['QDate'])/3600.
     # add used time
     if 'RemoteWallClockTime' in data:
         data['totalwalltimehrs'] = data['RemoteWallClockTime']/3600.
@@ -696,24 +894,15 @@ def add_classads(data):
         data['walltimehrs'] = 0.
 
     # fix Illume-MSU mixup
-    if site_key in data and data[site_key] == 'MSU' and data['date'] <= '2019-03-30' and data['date'] >= '2018-12-01':
+    if site_key in data and data[site_key] == 'MSU' and illume_msu_mixup[0] <= data['date'] <= illume_msu_mixup[1]:
         data[site_key] = 'Illume'
 
     # add site
-    if is_bad_site(data, site_key):
-        if 'LastRemoteHost' in data:
-            site = get_site_from_domain(data['LastRemoteHost'].split('@')[-1])
-            if site:
-                data['site'] = site
-            elif 'StartdPrincipal' in data:
-                ip = data['StartdPrincipal'].split('/')[-1]
-                site = get_site_from_ip_range(ip)
-                if site:
-                    data['site'] = site
-                else:
-                    data['site'] = 'other'
-    else:
-        data['site'] = get_site_from_resource(data[site_key])
+    data['site'] = site_resolver.resolve(
+        None if is_bad_site(data, site_key) else data[site_key],
+        data['LastRemoteHost'].split('@')[-1],
+        data['StartdPrincipal'].split('/')[-1],
+    )
 
     # add countries
     data['country'] = get_country_from_site(data['site'])
@@ -744,78 +933,293 @@ def classad_to_dict(c):
             ret[k] = c[k]
     return ret
 
-def read_from_file(filename):
+def is_history_key(name):
+    """Whether `filter_keys` would keep an attribute (before case folding)"""
+    return (name in good_keys or name.lower() == 'requestgpus'
+            or ('IceProd' in name and not name.endswith('InstanceId')))
+
+_number_re = re.compile(r'-?\d+(\.\d*)?([eE][-+]?\d+)?\Z')
+
+def parse_literal(value):
+    """Convert the text of a ClassAd literal to its python value.
+
+    Raises:
+        ValueError: if `value` is not a plain literal (e.g. an expression,
+                    a list, or a string with escapes)
+    """
+    if value.startswith('"'):
+        if len(value) > 1 and value.endswith('"') and '"' not in value[1:-1] and '\\' not in value:
+            return value[1:-1]
+        raise ValueError(value)
+    m = _number_re.match(value)
+    if m:
+        if m.group(1) is None and m.group(2) is None:
+            return int(value)
+        return float(value)
+    lower = value.lower()
+    if lower == 'true':
+        return True
+    elif lower == 'false':
+        return False
+    elif lower == 'undefined':
+        return classad.Value.Undefined
+    elif lower == 'error':
+        return classad.Value.Error
+    raise ValueError(value)
+
+def parse_history(lines, keys=is_history_key, offset=0):
+    """Parse condor history text into job dicts without building ClassAds.
+
+    Only attributes accepted by `keys` are decoded. Literal values are
+    converted directly; the classad library is only used for ads where a
+    wanted attribute is a real expression, and then only to evaluate those
+    attributes.
+
+    A generator that yields (offset, condor job dict) tuples, where offset
+    is the byte position just past the `***` line that terminates the ad.
+
+    Args:
+        lines (iterable): lines of history, as bytes
+        keys (callable): predicate on attribute names (None for all)
+        offset (int): byte position of the first line
+    """
+    wanted = {}  # memoized keys(name)
+    raw = []
+    entry = {}
+    exprs = []
+    for line in lines:
+        offset += len(line)
+        if line.startswith(b'***'):
+            try:
+                if exprs:
+                    c = classad.parseOne(b''.join(raw).decode('utf-8', errors='replace'))
+                    for k in exprs:
+                        try:
+                            entry[k] = c.eval(k)
+                        except TypeError:
+                            entry[k] = c[k]
+                yield offset, entry
+            except Exception:
+                logging.debug('bad ad before offset %d', offset, exc_info=True)
+            raw = []
+            entry = {}
+            exprs = []
+            continue
+        raw.append(line)
+        name, sep, value = line.partition(b'=')
+        if not sep:
+            continue
+        name = name.strip().decode('utf-8', errors='replace')
+        try:
+            want = wanted[name]
+        except KeyError:
+            want = wanted[name] = keys is None or keys(name)
+        if not want:
+            continue
+        value = value.strip().decode('utf-8', errors='replace')
+        try:
+            entry[name] = parse_literal(value)
+        except ValueError:
+            exprs.append(name)
+
+def read_from_file(filename, keys=is_history_key):
     """Read condor classads from file.
 
     A generator that yields condor job dicts.
 
     Args:
         filename (str): filename to read
+        keys (callable): predicate on attribute names to keep (None for all)
+    """
+    for _, data in read_from_file_offsets(filename, keys=keys):
+        yield data
+
+def read_from_file_offsets(filename, offset=0, keys=is_history_key):
+    """Read condor classads from file, keeping track of where each ends.
+
+    A generator that yields (offset, condor job dict) tuples, where offset
+    is the byte position just past the `***` line that terminates the ad
+    (in the decompressed stream, for gzipped files).
+
+    Args:
+        filename (str): filename to read
+        offset (int): position to start reading from; must be 0 or an
+                      offset previously yielded for the same file
+        keys (callable): predicate on attribute names to keep (None for all)
+    """
+    with (gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')) as f:
+        if offset:
+            f.seek(offset)
+        yield from parse_history(f, keys=keys, offset=offset)
+
+def merge_concurrently(sources, concurrency=8, timeout=None, maxsize=10000):
+    """Drain several generators from a bounded pool of threads.
+
+    A generator that yields items in the order they arrive from any source.
+    A source that runs longer than `timeout` seconds is abandoned, so one
+    hung source cannot stall the others.
+
+    Args:
+        sources (list): (name, callable returning an iterable) tuples
+        concurrency (int): max number of sources drained at once
+        timeout (float): max seconds to spend on each source (default: no limit)
+        maxsize (int): max number of items buffered before sources block
     """
-    with (gzip.open(filename, 'rt', encoding='utf-8') if filename.endswith('.gz') else open(filename)) as f:
-        entry = ''
-        for line in f.readlines():
-            if line.startswith('***'):
-                try:
-                    c = classad.parseOne(entry)
-                    yield classad_to_dict(c)
-                    entry = ''
-                except:
-                    entry = ''
+    results = queue.Queue(maxsize)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(key, name, func, deadline):
+        try:
+            for item in func():
+                if deadline and time.monotonic() > deadline:
+                    logging.warning('%s timed out', name)
+                    break
+                if not put((key, item)):
+                    break
+        except Exception:
+            logging.info('%s failed', name, exc_info=True)
+        finally:
+            put((key, finished))
+
+    pending = list(enumerate(sources))[::-1]
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < concurrency:
+                key, (name, func) = pending.pop()
+                deadline = time.monotonic()+timeout if timeout else None
+                running[key] = (name, deadline)
+                threading.Thread(target=run, args=(key, name, func, deadline), daemon=True).start()
+            # check deadlines every time around, as other sources streaming
+            # items would keep the get() below from ever timing out
+            now = time.monotonic()
+            for key, (name, deadline) in list(running.items()):
+                if deadline and deadline <= now:
+                    logging.warning('%s did not finish within %ds, giving up on it', name, timeout)
+                    del running[key]
+            if not running:
+                continue
+            deadlines = [d for _, d in running.values() if d]
+            wait = max(0, min(deadlines)-now) if deadlines else None
+            try:
+                key, item = results.get(timeout=wait)
+            except queue.Empty:
+                continue
+            if key not in running:
+                # late results from an abandoned source
+                continue
+            if item is finished:
+                del running[key]
             else:
-                entry += line+'\n'
+                yield item
+    finally:
+        stop.set()
+
+def map_windows(func, items, size=1000, concurrency=4):
+    """Apply `func` to consecutive windows of `items` on a bounded pool of threads.
 
-def read_from_collector(address, access_points=None, history=False, constraint='true', projection=[], match=10000):
+    A generator that yields the result for each window, in order. At most
+    `concurrency` windows are read ahead, so memory stays bounded no matter
+    how many items there are.
+
+    Args:
+        func (callable): called with a list of up to `size` items
+        items (iterable): items to process
+        size (int): items per window
+        concurrency (int): max number of windows processed at once
+    """
+    items = iter(items)
+    in_flight = deque()
+    with ThreadPoolExecutor(concurrency) as pool:
+        while True:
+            while len(in_flight) < concurrency:
+                window = list(islice(items, size))
+                if not window:
+                    break
+                in_flight.append(pool.submit(func, window))
+            if not in_flight:
+                break
+            yield in_flight.popleft().result()
+
+def read_from_collector(address, access_points=None, history=False, constraint='true', projection=[], match=10000,
+                        concurrency=8, schedd_timeout=600):
     """Connect to condor collectors and schedds to pull job ads directly.
 
-    A generator that yields condor job dicts.
+    A generator that yields condor job dicts. Schedds are queried
+    concurrently, and ads are yielded as they arrive.
 
     Args:
         address (str): address of collector
         history (bool): read history (True) or active queue (default: False)
+        concurrency (int): max number of schedds queried at once
+        schedd_timeout (float): seconds after which to give up on a schedd
     """
     import htcondor2 as htcondor
     coll = htcondor.Collector(address)
     schedd_ads = []
-    if access_points:
-        for ap in access_points.split(','):
-            schedd_ads.append(coll.locate(htcondor.DaemonTypes.Schedd, ap))
-    else:
-        schedd_ads = coll.locateAll(htcondor.DaemonTypes.Schedd)
+    with stage('collector_locate'):
+        if access_points:
+            for ap in access_points.split(','):
+                schedd_ads.append(coll.locate(htcondor.DaemonTypes.Schedd, ap))
+        else:
+            schedd_ads = coll.locateAll(htcondor.DaemonTypes.Schedd)
+
+    def query(schedd_ad):
+        logging.info('getting job ads from %s', schedd_ad['Name'])
+        schedd = htcondor.Schedd(schedd_ad)
+        timer = StageTimer('classad_to_dict')
+        try:
+            i = 0
+            if history:
+                start_dt = datetime.now()-timedelta(minutes=10)
+                start_stamp = time.mktime(start_dt.timetuple())
+                gen = schedd.history('(EnteredCurrentStatus >= {0}) && ({1})'.format(start_stamp,constraint),projection,match=match)
+            else:
+                gen = schedd.query(constraint, projection)
+            for i,entry in enumerate(timed_schedd(schedd_ad['Name'], gen)):
+                with timer:
+                    data = classad_to_dict(entry)
+                yield data
+            logging.info('got %d entries from %s', i, schedd_ad['Name'])
+        except Exception:
+            logging.info('%s failed', schedd_ad['Name'], exc_info=True)
+        finally:
+            timer.flush()
 
     if len(schedd_ads) == 0:
         logging.error(f'unable to locate access points %s from central manager %s', access_points, address)
         yield {}
     else:
-        for schedd_ad in schedd_ads:
-            logging.info('getting job ads from %s', schedd_ad['Name'])
-            schedd = htcondor.Schedd(schedd_ad)
-            try:
-                i = 0
-                if history:
-                    start_dt = datetime.now()-timedelta(minutes=10)
-                    start_stamp = time.mktime(start_dt.timetuple())
-                    gen = schedd.history('(EnteredCurrentStatus >= {0}) && ({1})'.format(start_stamp,constraint),projection,match=match)
-                else:
-                    gen = schedd.query(constraint, projection)
-                for i,entry in enumerate(gen):
-                    yield classad_to_dict(entry)
-                logging.info('got %d entries', i)
-            except Exception:
-                logging.info('%s failed', schedd_ad['Name'], exc_info=True)
+        yield from merge_concurrently(
+            [(schedd_ad['Name'], partial(query, schedd_ad)) for schedd_ad in schedd_ads],
+            concurrency=concurrency,
+            timeout=schedd_timeout,
+        )
 
 
-def read_status_from_collector(address, after=datetime.now()-timedelta(hours=1)):
+def read_status_from_collector(address, after=None):
     """Connect to condor collectors and schedds to pull job ads directly.
 
     A generator that yields condor job dicts.
 
     Args:
         address (str): address of collector
-        history (bool): read history (True) or active queue (default: False)
+        after (datetime): only read slots heard from since then (default: an hour ago)
     """
     import htcondor2 as htcondor
     coll = htcondor.Collector(address)
+    if after is None:
+        after = datetime.now()-timedelta(hours=1)
     start_stamp = time.mktime(after.timetuple())
     final_keys = [
         "Name",
@@ -835,18 +1239,21 @@ def read_status_from_collector(address, after=datetime.now()-timedelta(hours=1))
         "GPU_NAMES",
     ]
     site_key = "GLIDEIN_SiteResource"
+    timer = StageTimer('classad_to_dict')
     try:
-        gen = coll.query(
-            htcondor.AdTypes.Startd,
-            (
-                "SlotType isnt \"Dynamic\" && LastHeardFrom>={}"
-                .format(start_stamp)
-            ),
-            final_keys + temp_keys
-        )
+        with stage('collector_query'):
+            gen = coll.query(
+                htcondor.AdTypes.Startd,
+                (
+                    "SlotType isnt \"Dynamic\" && LastHeardFrom>={}"
+                    .format(start_stamp)
+                ),
+                final_keys + temp_keys
+            )
         i = 0
         for i,entry in enumerate(gen):
-            data = classad_to_dict(entry)
+            with timer:
+                data = classad_to_dict(entry)
             for k in "DaemonStartTime", "LastHeardFrom":
                 data[k] = datetime.utcfromtimestamp(data[k])
             data["@timestamp"] = [data["DaemonStartTime"]]
@@ -859,19 +1266,12 @@ def read_status_from_collector(address, after=datetime.now()-timedelta(hours=1))
             data['resource'] = data[site_key]
 
             # add site
-            if is_bad_site(data, site_key):
-                site = get_site_from_domain(data['Name'].split('@')[-1])
-                if site:
-                    data['site'] = site
-                else:
-                    ip = re.match(r'.*?(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}).*', data['AddressV1']).group(1)
-                    site = get_site_from_ip_range(ip)
-                    if site:
-                        data['site'] = site
-                    else:
-                        data['site'] = 'other'
-            else:
-                data['site'] = get_site_from_resource(data[site_key])
+            ip = re.search(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', data.get('AddressV1', ''))
+            data['site'] = site_resolver.resolve(
+                None if is_bad_site(data, site_key) else data[site_key],
+                data['Name'].split('@')[-1],
+                ip.group(0) if ip else '',
+            )
 
             # add countries
             data['country'] = get_country_from_site(data['site'])
@@ -890,3 +1290,5 @@ def read_status_from_collector(address, after=datetime.now()-timedelta(hours=1))
         logging.info('got %d entries', i)
     except Exception:
         logging.info('failed', exc_info=True)
+    finally:
+        timer.flush()
@@ -0,0 +1,270 @@
+"""
+Parallel bulk indexing with adaptive chunk sizes
+"""
+
+import time
+import random
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import ApiError, ConnectionError, ConnectionTimeout
+from elasticsearch.helpers import BulkIndexError, expand_action
+
+from stage_metrics import StageTimer, bulk_seconds, bulk_retries
+
+logger = logging.getLogger('es_bulk')
+
+
+def is_rejected(status, error=None):
+    """Is this the cluster pushing back, rather than a bad document?"""
+    if status == 429:
+        return True
+    if isinstance(error, dict):
+        return error.get('type') == 'es_rejected_execution_exception'
+    return False
+
+
+class Throttle:
+    """Additive-increase/multiplicative-decrease control of bulk chunk
+    size (in serialized bytes) and the number of concurrent requests.
+
+    While requests come back faster than `target_latency`, the chunk size
+    grows, and once it reaches `max_chunk_bytes`, concurrency grows. Slow
+    requests shrink the chunk size. Rejections (429 or
+    es_rejected_execution_exception) halve both.
+
+    Args:
+        chunk_bytes (int): starting chunk size
+        min_chunk_bytes (int): smallest chunk size
+        max_chunk_bytes (int): largest chunk size
+        concurrency (int): starting number of requests in flight
+        max_concurrency (int): largest number of requests in flight
+        target_latency (float): seconds a bulk request should take
+    """
+    def __init__(self, chunk_bytes=1<<20, min_chunk_bytes=64<<10, max_chunk_bytes=16<<20,
+                 concurrency=2, max_concurrency=8, target_latency=2.):
+        self.min_chunk_bytes = min_chunk_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.chunk_bytes = max(min_chunk_bytes, min(chunk_bytes, max_chunk_bytes))
+        self.max_concurrency = max_concurrency
+        self.concurrency = max(1, min(concurrency, max_concurrency))
+        self.target_latency = target_latency
+
+    def observe(self, latency, rejected=0):
+        """Adjust after a bulk request (including its retries) finished"""
+        if rejected:
+            self.concurrency = max(1, self.concurrency // 2)
+            self.chunk_bytes = max(self.min_chunk_bytes, self.chunk_bytes // 2)
+            logger.info('bulk rejections, backing off to %d requests of %d bytes',
+                        self.concurrency, self.chunk_bytes)
+        elif latency > 2*self.target_latency:
+            self.chunk_bytes = max(self.min_chunk_bytes, int(self.chunk_bytes * 0.75))
+        elif latency < self.target_latency:
+            if self.chunk_bytes < self.max_chunk_bytes:
+                self.chunk_bytes = min(self.max_chunk_bytes, self.chunk_bytes + self.min_chunk_bytes)
+            elif self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+
+
+def chunk_actions(actions, serializer, throttle, chunk_size):
+    """Group actions into chunks of about `throttle.chunk_bytes` serialized
+    bytes, and at most `chunk_size` actions.
+
+    Yields lists of (op_type, action line, data line, raw data) tuples.
+    """
+    chunk = []
+    size = 0
+    timer = StageTimer('serialize')
+    for action in actions:
+        with timer:
+            action, data = expand_action(action)
+            op_type = next(iter(action))
+            line = serializer.dumps(action)
+            size += len(line) + 1
+            if data is not None:
+                data_line = serializer.dumps(data)
+                size += len(data_line) + 1
+            else:
+                data_line = None
+        chunk.append((op_type, line, data_line, data))
+        if size >= throttle.chunk_bytes or len(chunk) >= chunk_size:
+            timer.flush()
+            yield chunk
+            chunk = []
+            size = 0
+    timer.flush()
+    if chunk:
+        yield chunk
+
+
+def send_chunk(client, chunk, max_retries, initial_backoff, max_backoff, **kwargs):
+    """Send one chunk, retrying rejected actions with exponential backoff.
+
+    Returns:
+        (list, float, int): (ok, info) per action in chunk order, seconds
+                            taken by the last attempt, number of rejections
+    """
+    results = [None]*len(chunk)
+    todo = list(range(len(chunk)))
+    rejected = 0
+    latency = 0.
+    for attempt in range(max_retries+1):
+        if attempt:
+            time.sleep(min(max_backoff, initial_backoff * 2**(attempt-1)) * random.uniform(.5, 1.))
+        operations = []
+        for i in todo:
+            op_type, line, data_line, data = chunk[i]
+            operations.append(line)
+            if data_line is not None:
+                operations.append(data_line)
+        start = time.monotonic()
+        try:
+            resp = client.bulk(operations=operations, **kwargs)
+        except ApiError as e:
+            if not is_rejected(e.status_code) or attempt == max_retries:
+                raise
+            rejected += 1
+            bulk_retries.labels('rejected').inc()
+            continue
+        except (ConnectionError, ConnectionTimeout):
+            if attempt == max_retries:
+                raise
+            rejected += 1
+            bulk_retries.labels('connection').inc()
+            continue
+        latency = time.monotonic() - start
+        bulk_seconds.observe(latency)
+
+        retry = []
+        for i, item in zip(todo, resp['items']):
+            op_type, info = item.popitem()
+            status = info.get('status', 500)
+            ok = 200 <= status < 300
+            if not ok and is_rejected(status, info.get('error')) and attempt < max_retries:
+                retry.append(i)
+                continue
+            if not ok and chunk[i][3] is not None:
+                info['data'] = chunk[i][3]
+            results[i] = (ok, {op_type: info})
+        if retry:
+            rejected += 1
+            bulk_retries.labels('rejected_items').inc()
+        todo = retry
+        if not todo:
+            break
+    return results, latency, rejected
+
+
+def streaming_bulk(client, actions, chunk_size=5000, max_retries=20, initial_backoff=2,
+                   max_backoff=600, raise_on_error=True, yield_ok=True, throttle=None,
+                   dead_letter=None, **kwargs):
+    """Drop-in replacement for `elasticsearch.helpers.streaming_bulk` that
+    sends several bulk requests at a time.
+
+    Chunks are sized by serialized bytes and both their size and the
+    number of requests in flight adapt to the cluster, see `Throttle`.
+    `chunk_size` only caps the number of actions in a chunk.
+
+    Results are yielded in the same order as `actions`, so callers can
+    checkpoint on the number of results seen.
+
+    Args:
+        client (Elasticsearch): client, shared by the worker threads
+        actions (iterable): bulk actions, as for the standard helpers
+        chunk_size (int): most actions in one request
+        max_retries (int): times to retry rejected actions
+        initial_backoff (float): seconds to wait before the first retry
+        max_backoff (float): most seconds to wait between retries
+        raise_on_error (bool): raise BulkIndexError for failed actions
+        yield_ok (bool): yield results of successful actions
+        throttle (Throttle): controller, to start from non-default settings
+        dead_letter (callable): gets each failed `{op_type: info}` item;
+                                failures it took do not raise
+
+    Yields:
+        (bool, dict): success and response item for each action
+    """
+    if throttle is None:
+        throttle = Throttle()
+    serializer = client.transport.serializers.get_serializer('application/json')
+    chunks = chunk_actions(actions, serializer, throttle, chunk_size)
+    in_flight = deque()
+    with ThreadPoolExecutor(throttle.max_concurrency) as pool:
+        def submit():
+            while len(in_flight) < throttle.concurrency:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                in_flight.append(pool.submit(send_chunk, client, chunk, max_retries,
+                                             initial_backoff, max_backoff, **kwargs))
+
+        submit()
+        while in_flight:
+            results, latency, rejected = in_flight.popleft().result()
+            throttle.observe(latency, rejected)
+            errors = [info for ok, info in results if not ok] if not dead_letter else []
+            if errors and raise_on_error:
+                # raise before yielding any of the chunk, like the standard
+                # helper, so no caller counts results past a failure as done
+                for future in in_flight:
+                    future.cancel()
+                raise BulkIndexError(f'{len(errors)} document(s) failed to index.', errors)
+            for ok, info in results:
+                if not ok and dead_letter:
+                    dead_letter(info)
+                if not ok or yield_ok:
+                    yield ok, info
+            submit()
+    logger.debug('finished with %d requests of %d bytes', throttle.concurrency, throttle.chunk_bytes)
+
+
+def ack_results(results, on_ack, every=500, dead_letter=False):
+    """Pass through `streaming_bulk` results (with `yield_ok`), calling
+    `on_ack(n)` each time another `every` leading actions are done, and
+    once at the end. n counts the actions before the first failure that
+    was not taken by a dead letter queue, so a checkpoint built on it never
+    moves past a document that was not indexed.
+
+    Args:
+        results (iterable): (ok, info) for each action, in order
+        on_ack (callable): called with the number of actions done
+        every (int): actions between calls
+        dead_letter (bool): whether failures went to a dead letter queue
+    """
+    acked = 0
+    blocked = False
+    try:
+        for ok, info in results:
+            if not ok and not dead_letter:
+                blocked = True
+            if not blocked:
+                acked += 1
+                if acked % every == 0:
+                    on_ack(acked)
+            yield ok, info
+    finally:
+        if acked % every:
+            on_ack(acked)
+
+
+def bulk(client, actions, stats_only=False, **kwargs):
+    """Drop-in replacement for `elasticsearch.helpers.bulk`, using
+    `streaming_bulk` from this module.
+
+    Failures handed to a `dead_letter` are counted but not returned.
+
+    Returns:
+        (int, list or int): number of successes, and the errors (or their
+                            count if `stats_only`)
+    """
+    success, failed = 0, 0
+    errors = []
+    for ok, item in streaming_bulk(client, actions, **kwargs):
+        if not ok:
+            if not stats_only and not kwargs.get('dead_letter'):
+                errors.append(item)
+            failed += 1
+        else:
+            success += 1
+    return success, failed if stats_only else errors
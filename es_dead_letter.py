@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Keep bulk actions that elasticsearch rejected, and replay them later
+"""
+
+import os
+import glob
+import gzip
+import json
+import time
+import socket
+import logging
+import itertools
+from collections import Counter
+from argparse import ArgumentParser
+
+logger = logging.getLogger('es_dead_letter')
+_sequence = itertools.count()
+
+
+def error_type(info):
+    """Error type of a failed bulk response item, e.g. mapper_parsing_exception"""
+    error = info.get('error')
+    if isinstance(error, dict):
+        return error.get('type', 'unknown')
+    if error:
+        return str(error).split('(', 1)[0].strip() or 'unknown'
+    return 'status_{}'.format(info.get('status', 'unknown'))
+
+
+def error_counts(errors):
+    """Count failed bulk response items by error type"""
+    return Counter(error_type(info) for item in errors for info in item.values())
+
+
+class DeadLetterQueue:
+    """Failed bulk actions, stored as compact gzipped JSON lines.
+
+    Every writer gets its own file per error type, named
+    `<dir>/<error type>/<time>-<host>-<pid>-<seq>-<count>.jsonl.gz`. Files only
+    get their final name on `close()`, so several processes can share a
+    directory, and counts are known without reading the files.
+
+    Each line holds the action, ready to resubmit, and the status and
+    reason it failed with.
+
+    Args:
+        directory (str): dead-letter directory
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.prefix = '{:.0f}-{}-{}-{}'.format(time.time(), socket.gethostname(), os.getpid(), next(_sequence))
+        self.files = {}
+        self.counts = Counter()
+
+    def add(self, item):
+        """Add a failed `{op_type: info}` item, as from `es_bulk.streaming_bulk`"""
+        (op_type, info), = item.items()
+        action = {'_op_type': op_type, '_index': info.get('_index')}
+        if info.get('_id') is not None:
+            action['_id'] = info['_id']
+        data = info.get('data')
+        if data is not None:
+            if op_type in ('index', 'create'):
+                action['_source'] = data
+            else:
+                action.update(data)
+        error = info.get('error')
+        reason = error.get('reason') if isinstance(error, dict) else error
+        etype = error_type(info)
+        if etype not in self.files:
+            os.makedirs(os.path.join(self.directory, etype), exist_ok=True)
+            self.files[etype] = gzip.open(self._path(etype) + '.tmp', 'wt')
+        json.dump({'action': action, 'status': info.get('status'), 'reason': str(reason)[:1000]},
+                  self.files[etype], separators=(',', ':'), default=str)
+        self.files[etype].write('\n')
+        self.counts[etype] += 1
+
+    __call__ = add
+
+    def _path(self, etype, count=None):
+        name = self.prefix if count is None else '{}-{}.jsonl.gz'.format(self.prefix, count)
+        return os.path.join(self.directory, etype, name)
+
+    def close(self):
+        """Finish the files written so far"""
+        for etype, f in self.files.items():
+            f.close()
+            os.rename(self._path(etype) + '.tmp', self._path(etype, self.counts[etype]))
+        if self.counts:
+            logger.warning('dead-lettered %d actions to %s: %s', sum(self.counts.values()),
+                           self.directory, ', '.join(f'{k}={v}' for k,v in self.counts.most_common()))
+        self.files = {}
+        self.counts = Counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def dead_letter_files(directory, error_types=None):
+    """Finished dead-letter files, as (error type, count, path)"""
+    for path in sorted(glob.glob(os.path.join(directory, '*', '*.jsonl.gz'))):
+        etype = os.path.basename(os.path.dirname(path))
+        if error_types and etype not in error_types:
+            continue
+        count = int(os.path.basename(path)[:-len('.jsonl.gz')].rsplit('-', 1)[-1])
+        yield etype, count, path
+
+
+def summary(directory):
+    """Count dead-lettered actions by error type"""
+    counts = Counter()
+    for etype, count, _ in dead_letter_files(directory):
+        counts[etype] += count
+    return counts
+
+
+def read_actions(path):
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            yield json.loads(line)['action']
+
+
+def replay(client, directory, error_types=None, **kwargs):
+    """Resubmit dead-lettered actions.
+
+    Each file is removed once its actions have been sent. Actions that
+    fail again are dead-lettered anew, under their new error type.
+
+    Returns:
+        (int, int): number of actions indexed, number that failed again
+    """
+    from es_bulk import streaming_bulk
+
+    success, failed = 0, 0
+    with DeadLetterQueue(directory) as dead_letter:
+        for etype, count, path in list(dead_letter_files(directory, error_types)):
+            logger.info('replaying %d %s actions from %s', count, etype, path)
+            for ok, _ in streaming_bulk(client, read_actions(path), dead_letter=dead_letter, **kwargs):
+                if ok:
+                    success += 1
+                else:
+                    failed += 1
+            os.remove(path)
+    return success, failed
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-a', '--address', help='elasticsearch address')
+    parser.add_argument('--token', help='oauth2 token', default=None)
+    parser.add_argument('-t', '--types', default=None,
+                        help='comma separated error types to replay (default all)')
+    parser.add_argument('command', choices=('summary', 'replay'))
+    parser.add_argument('directory', help='dead-letter directory')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s : %(message)s')
+
+    if options.command == 'summary':
+        for etype, count in summary(options.directory).most_common():
+            print(f'{count:>10} {etype}')
+        return
+
+    if not options.address:
+        parser.error('replay needs --address')
+    from elasticsearch import Elasticsearch
+
+    url = options.address if '://' in options.address else 'http://' + options.address
+    logging.info('connecting to ES at %s', url)
+    es = Elasticsearch(hosts=[url], request_timeout=5000, bearer_auth=options.token)
+    success, failed = replay(es, options.directory,
+                             error_types=options.types.split(',') if options.types else None,
+                             max_retries=20, initial_backoff=2, max_backoff=360)
+    print(f'Replayed {success} actions, {failed} failed again')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Local index of the glidein docs condor_status_to_es has written
+"""
+
+import time
+import sqlite3
+import logging
+import threading
+
+
+class GlideinIndex:
+    """Map (slot name, DaemonStartTime) to the ES doc of that glidein.
+
+    Filled as machines are upserted, so jobs can be attributed to the
+    glidein they ran in without searching ES. The index also records since
+    when it has seen every glidein: a glidein that started earlier may have
+    been missed, so lookups that land before that time are left to ES.
+
+    Safe to share between threads.
+
+    Args:
+        path (str): sqlite database to keep the index in
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = []
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS glideins (
+                    name TEXT NOT NULL,
+                    start REAL NOT NULL,
+                    doc_id TEXT NOT NULL,
+                    idx TEXT NOT NULL,
+                    PRIMARY KEY (name, start)
+                )""")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value REAL
+                )""")
+        self.covered_since = self._get('covered_since')
+
+    def _get(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def close(self):
+        self.db.close()
+
+    def add(self, name, start, doc_id, index):
+        """Record a glidein doc, written on the next `commit()`
+
+        Args:
+            name (str): slot name
+            start (float): DaemonStartTime, in epoch seconds
+            doc_id (str): ES doc id
+            index (str): ES index
+        """
+        with self.lock:
+            self.pending.append((name, start, doc_id, index))
+
+    def commit(self, after, queried):
+        """Write the glideins added since the last commit.
+
+        Args:
+            after (float): epoch seconds since which the collector was asked
+                           for every glidein it heard from
+            queried (float): epoch seconds when the collector was asked
+        """
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO glideins (name, start, doc_id, idx) VALUES (?, ?, ?, ?)',
+                                self.pending)
+            last_update = self._get('last_update')
+            if self.covered_since is None or last_update is None or last_update < after:
+                # first run, or a gap since the last one in which glideins may have been missed
+                if self.covered_since is not None:
+                    logging.info('glidein index has a gap, only trusting glideins started after %s',
+                                 time.ctime(after))
+                self.covered_since = after
+                self._set('covered_since', after)
+            self._set('last_update', queried)
+            self.pending = []
+
+    def discard(self):
+        """Drop the glideins added since the last commit, when their docs
+        may not have been written. Coverage is not extended, so the next
+        commit still has to reach back to the last good one."""
+        with self.lock:
+            self.pending = []
+
+    def lookup(self, name, before):
+        """Find the newest glidein named `name` that started no later than `before`.
+
+        Returns:
+            (str, str): ES (index, doc id), or None if ES has to be asked
+        """
+        if self.covered_since is None:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                'SELECT start, idx, doc_id FROM glideins WHERE name = ? AND start <= ? ORDER BY start DESC LIMIT 1',
+                (name, before)).fetchone()
+        if row is None or row[0] < self.covered_since:
+            # a newer glidein may have started before the index saw everything
+            return None
+        return row[1], row[2]
+
+    def prune(self, retention):
+        """Forget glideins that started more than `retention` seconds ago"""
+        cutoff = time.time() - retention
+        with self.lock, self.db:
+            n = self.db.execute('DELETE FROM glideins WHERE start < ?', (cutoff,)).rowcount
+        if n:
+            logging.info('pruned %d glideins from %s', n, self.path)
@@ -0,0 +1,180 @@
+"""
+Exact time-bin overlap of glidein resources, computed client-side
+"""
+
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+from elasticsearch.helpers import scan
+
+from status_updates import RESOURCES, STATUSES
+
+KEYS = ("site", "country", "institution", "resource")
+CLAIMS = STATUSES + ("total",)
+
+# summed fields, named like the painless summary names them
+COLUMNS = (
+    [f"claimed.{status}.{resource}" for resource in RESOURCES for status in CLAIMS]
+    + [f"offered.{resource}" for resource in RESOURCES]
+)
+
+
+class OverlapSums:
+    """Sum glidein resources over fixed time bins, weighting each glidein by
+    the fraction of each bin it was alive for.
+
+    Bins are aligned to the epoch, like a fixed_interval date_histogram,
+    and only bins starting in [after, before) are kept.
+
+    Safe to share between threads.
+
+    Args:
+        after (int): epoch millis
+        before (int): epoch millis
+        interval (int): bin width in millis
+    """
+    def __init__(self, after, before, interval):
+        self.interval = interval
+        self.first = -(-after // interval)
+        self.nbins = max(0, -(-before // interval) - self.first)
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.count = np.zeros((0, self.nbins), dtype=np.int64)
+        self.sums = np.zeros((len(COLUMNS), 0, self.nbins))
+
+    def _grow(self, ngroups):
+        if ngroups <= self.count.shape[0]:
+            return
+        extra = max(ngroups, 2*self.count.shape[0]) - self.count.shape[0]
+        self.count = np.concatenate([self.count, np.zeros((extra, self.nbins), dtype=np.int64)])
+        self.sums = np.concatenate([self.sums, np.zeros((len(COLUMNS), extra, self.nbins))], axis=1)
+
+    def add(self, keys, start, end, weights):
+        """Add a batch of glideins.
+
+        Args:
+            keys (list): group key tuple of each glidein
+            start (array): DaemonStartTime of each glidein, in epoch millis
+            end (array): LastHeardFrom of each glidein, in epoch millis
+            weights (array): value of each of `COLUMNS` for each glidein,
+                             shape (len(COLUMNS), len(keys))
+        """
+        if not self.nbins or not keys:
+            return
+        start = np.asarray(start, dtype=float)
+        end = np.maximum(np.asarray(end, dtype=float), start)
+        lo = np.maximum(np.floor(start / self.interval).astype(np.int64), self.first)
+        hi = np.minimum(np.floor(end / self.interval).astype(np.int64), self.first + self.nbins - 1)
+        n = np.maximum(hi - lo + 1, 0)
+
+        # one row per (glidein, bin) it overlaps
+        doc = np.repeat(np.arange(len(keys)), n)
+        k = lo[doc] + np.arange(len(doc)) - np.repeat(np.cumsum(n) - n, n)
+        left = k * float(self.interval)
+        overlap = np.minimum(end[doc], left + self.interval) - np.maximum(start[doc], left)
+        fraction = np.clip(overlap, 0, None) / self.interval
+
+        with self.lock:
+            ids = np.fromiter((self.groups.setdefault(key, len(self.groups)) for key in keys),
+                              dtype=np.int64, count=len(keys))
+            self._grow(len(self.groups))
+            cells = self.count.shape[0] * self.nbins
+            flat = ids[doc] * self.nbins + (k - self.first)
+            self.count += np.bincount(flat, minlength=cells).reshape(self.count.shape)
+            for i in range(len(COLUMNS)):
+                self.sums[i] += np.bincount(flat, weights=weights[i][doc] * fraction,
+                                            minlength=cells).reshape(self.count.shape)
+
+    def summaries(self):
+        """Yield non-empty bins, in the form `resource_summaries` does"""
+        for key, row in sorted(self.groups.items()):
+            for j in np.flatnonzero(self.count[row]):
+                timestamp = datetime.datetime.fromtimestamp((self.first + j) * self.interval / 1000,
+                                                            tz=datetime.timezone.utc)
+                data = {name: float(self.sums[i, row, j]) for i, name in enumerate(COLUMNS)}
+                data["count"] = int(self.count[row, j])
+                data["_keys"] = dict(zip(KEYS + ("slot_type",), key))
+                data["_keys"]["timestamp"] = timestamp.strftime("%Y-%m-%dT%H:%M:%S")
+                yield data
+
+
+def read_batch(hits):
+    """Group keys, lifetimes and `COLUMNS` weights of a batch of hits with docvalue fields"""
+    keys, start, end = [], [], []
+    weights = np.zeros((len(COLUMNS), len(hits)))
+    for hit in hits:
+        fields = hit.get("fields", {})
+        def get(name):
+            return fields.get(name, [None])[0]
+        key = tuple(get(k + ".keyword") for k in KEYS)
+        if None in key or get("DaemonStartTime") is None or get("LastHeardFrom") is None:
+            # not in any composite bucket either
+            continue
+        col = len(keys)
+        keys.append(key + ("GPU" if (get("TotalGPUs") or 0) > 0 else "CPU",))
+        start.append(float(get("DaemonStartTime")))
+        end.append(float(get("LastHeardFrom")))
+        i = 0
+        for resource in RESOURCES:
+            capacity = get("Total" + resource) or 0
+            for status in CLAIMS:
+                weights[i, col] = capacity * (get(f"occupancy.{status}.{resource}") or 0)
+                i += 1
+        for resource in RESOURCES:
+            weights[i, col] = get("Total" + resource) or 0
+            i += 1
+    return keys, start, end, weights[:, :len(keys)]
+
+
+def resource_summaries(client, index, after, before, interval, slices=4, batch_size=5000):
+    """Summarize glideins alive in [after, before) into bins of `interval`,
+    reading them with a sliced scroll.
+
+    Unlike the painless summary, each glidein contributes to every bin it
+    overlaps, weighted by the exact overlap.
+
+    Args:
+        client (Elasticsearch): client
+        index (str): glidein index
+        after (datetime): start of the first bin
+        before (datetime): end of the last bin
+        interval (timedelta): bin width
+        slices (int): scroll slices to read in parallel
+        batch_size (int): hits per scroll page
+    """
+    after_ms = int(after.timestamp() * 1000)
+    before_ms = int(before.timestamp() * 1000)
+    sums = OverlapSums(after_ms, before_ms, int(interval.total_seconds() * 1000))
+    query = {
+        "query": {"bool": {"filter": [
+            {"range": {"LastHeardFrom": {"gte": after_ms, "format": "epoch_millis"}}},
+            {"range": {"DaemonStartTime": {"lt": before_ms, "format": "epoch_millis"}}},
+        ]}},
+        "_source": False,
+        "docvalue_fields": (
+            [{"field": f, "format": "epoch_millis"} for f in ("DaemonStartTime", "LastHeardFrom")]
+            + [k + ".keyword" for k in KEYS]
+            + ["Total" + resource for resource in RESOURCES]
+            + [f"occupancy.{status}.{resource}" for resource in RESOURCES for status in CLAIMS]
+        ),
+    }
+
+    def read_slice(i):
+        body = dict(query, slice={"id": i, "max": slices}) if slices > 1 else query
+        hits = scan(client, query=body, index=index, scroll="5m", size=batch_size)
+        n = 0
+        while True:
+            batch = list(islice(hits, batch_size))
+            if not batch:
+                return n
+            sums.add(*read_batch(batch))
+            n += len(batch)
+
+    with ThreadPoolExecutor(slices) as pool:
+        total = sum(pool.map(read_slice, range(slices)))
+    logging.info("summed %d glideins into %d groups", total, len(sums.groups))
+    return sums.summaries()
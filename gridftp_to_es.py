@@ -54,7 +54,7 @@ def es_generator(entries):
         yield data
 
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+from es_bulk import bulk
 
 prefix = 'http'
 address = options.address
@@ -0,0 +1,99 @@
+"""
+Track how far each condor history file has been ingested
+"""
+
+import os
+import sqlite3
+import logging
+
+
+class HistoryCheckpoint:
+    """Persistent byte-offset checkpoints for condor history files.
+
+    Files are identified by (device, inode) rather than by name, so a
+    history file that condor rotates to a new name keeps its checkpoint,
+    and the fresh file that replaces it starts from the beginning.
+
+    Offsets always point just past a `***` banner line, i.e. at the start
+    of the next ad. For gzipped files they are offsets into the
+    decompressed stream.
+
+    Args:
+        path (str): sqlite database to keep checkpoints in
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    device INTEGER NOT NULL,
+                    inode INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    complete INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (device, inode)
+                )""")
+
+    def close(self):
+        self.db.close()
+
+    def resume_offset(self, filename):
+        """Get the offset to resume reading `filename` from.
+
+        Returns:
+            int: offset of the first ad that has not been indexed, or None
+                 if the file is unchanged since it was fully indexed
+        """
+        st = os.stat(filename)
+        row = self.db.execute(
+            'SELECT path, size, offset, complete FROM files WHERE device=? AND inode=?',
+            (st.st_dev, st.st_ino),
+        ).fetchone()
+        if row is None:
+            return 0
+        path, size, offset, complete = row
+        if st.st_size < size:
+            # truncated, or the inode was reused for a new file
+            logging.info('%s shrank from %d to %d bytes, starting over', filename, size, st.st_size)
+            return 0
+        if path != filename:
+            logging.info('%s was rotated to %s', path, filename)
+            with self.db:
+                self.db.execute('UPDATE files SET path=? WHERE device=? AND inode=?',
+                                (filename, st.st_dev, st.st_ino))
+        if complete and st.st_size == size:
+            return None
+        return offset
+
+    def update(self, filename, offset, complete=False, size=None):
+        """Record that every ad in `filename` before `offset` is indexed.
+
+        Args:
+            filename (str): history file
+            offset (int): offset just past the last acknowledged ad
+            complete (bool): whether the whole file has been read
+            size (int): file size when reading started (default: current size)
+        """
+        st = os.stat(filename)
+        if size is None:
+            size = st.st_size
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (device, inode, path, size, offset, complete) VALUES (?,?,?,?,?,?)',
+                (st.st_dev, st.st_ino, filename, size, offset, int(complete)),
+            )
+
+    def prune(self):
+        """Forget files that no longer exist"""
+        rows = self.db.execute('SELECT device, inode, path FROM files').fetchall()
+        with self.db:
+            for device, inode, path in rows:
+                try:
+                    st = os.stat(path)
+                    if (st.st_dev, st.st_ino) == (device, inode):
+                        continue
+                except OSError:
+                    pass
+                self.db.execute('DELETE FROM files WHERE device=? AND inode=?', (device, inode))
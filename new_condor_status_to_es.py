@@ -12,16 +12,18 @@ import textwrap
 from argparse import ArgumentParser
 from datetime import datetime, timedelta
 from functools import partial
+from itertools import chain
 from time import mktime
 
 import elasticsearch_dsl as edsl
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, BulkIndexError
+from elasticsearch.helpers import BulkIndexError
 from elasticsearch_dsl import MultiSearch, Search
 import htcondor2 as htcondor
 from rest_tools.client import ClientCredentialsAuth
 
 from condor_utils import *
+from es_bulk import bulk
 
 regex = re.compile(
     r"((?P<days>\d+?)d)?((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?"
@@ -77,27 +79,22 @@ def update_machines(entries, index):
             "_id": f"{data['LastHeardFrom']}-{data['Name']}",
         }
 
-def update_jobs(es, index, entries, history=False):
+def parent_slot_name(dynamic_slot_name):
+    parts = dynamic_slot_name.split("@")
+    match = re.match(r"(slot\d+)_\d+", parts[0])
+    if match:
+        parts[0] = match.group(1)
+    return "@".join(parts)
+
+def match_jobs(es, index, jobs, history=False):
     """
-    Generate updates to claims.* from job classad dictionaries
+    Find the glidein each job ran in, as a list of (job, response) tuples
     """
-
-    def parent_slot_name(dynamic_slot_name):
-        parts = dynamic_slot_name.split("@")
-        match = re.match(r"(slot\d+)_\d+", parts[0])
-        if match:
-            parts[0] = match.group(1)
-        return "@".join(parts)
-
-    # MultiSearch will fail if there are no queries to run
-    jobs = list(entries)
-    if not jobs:
-        return
-
     # glidein names are not necessarily unique on long time scales. look up the
     # last glidein that started with the advertised name _before_ the evicted
     # job was started
     ms = MultiSearch(using=es, index=index)
+    matched = []
     for hit in jobs:
         try:
             if history:
@@ -114,11 +111,30 @@ def update_jobs(es, index, entries, history=False):
                 .sort({"DaemonStartTime": {"order": "desc"}})
                 .source(["nuthin"])[:1]
             )
+            matched.append(hit)
         except Exception:
             logging.warning('failed to process job, %r', hit)
             continue
 
-    for hit, match in zip(jobs, ms.execute()):
+    # MultiSearch will fail if there are no queries to run
+    if not matched:
+        return []
+    return list(zip(matched, ms.execute()))
+
+def update_jobs(es, index, entries, history=False, window_size=1000, concurrency=4):
+    """
+    Generate updates to claims.* from job classad dictionaries
+
+    Jobs are matched in windows of `window_size`, with up to `concurrency`
+    msearch requests in flight, and updates follow as each window resolves.
+    """
+    windows = map_windows(
+        lambda jobs: match_jobs(es, index, jobs, history),
+        entries,
+        size=window_size,
+        concurrency=concurrency,
+    )
+    for hit, match in chain.from_iterable(windows):
         if not match.hits:
             continue
         if history:
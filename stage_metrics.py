@@ -0,0 +1,115 @@
+"""
+Time spent in each stage of the ingest pipelines, as prometheus metrics
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, multiprocess, write_to_textfile
+
+registry = CollectorRegistry()
+
+stage_seconds = Counter('monitoring_stage_seconds', 'Time spent in a pipeline stage',
+                        ['stage'], registry=registry)
+stage_items = Counter('monitoring_stage_items', 'Items processed by a pipeline stage',
+                      ['stage'], registry=registry)
+schedd_query_seconds = Histogram('monitoring_schedd_query_seconds', 'Time to read all ads from a schedd',
+                                 ['schedd'], registry=registry,
+                                 buckets=(.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf')))
+schedd_ads = Counter('monitoring_schedd_ads', 'Ads read from a schedd',
+                     ['schedd'], registry=registry)
+bulk_seconds = Histogram('monitoring_es_bulk_seconds', 'Round trip time of elasticsearch bulk requests',
+                         registry=registry,
+                         buckets=(.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, float('inf')))
+bulk_retries = Counter('monitoring_es_bulk_retries', 'Elasticsearch bulk requests retried',
+                       ['reason'], registry=registry)
+
+
+def record(stage, seconds, items=1):
+    """Add time and items to a stage"""
+    stage_seconds.labels(stage).inc(seconds)
+    stage_items.labels(stage).inc(items)
+
+
+@contextmanager
+def stage(name, items=1):
+    """Time a block of code as one pass of a stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, items)
+
+
+class StageTimer:
+    """Time each item of a stage in a hot loop, touching the metrics only
+    once in `flush()`:
+
+        timer = StageTimer('add_classads')
+        for data in entries:
+            with timer:
+                add_classads(data)
+        timer.flush()
+    """
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.
+        self.items = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += time.perf_counter() - self.start
+        self.items += 1
+
+    def flush(self):
+        if self.items:
+            record(self.name, self.seconds, self.items)
+        self.seconds = 0.
+        self.items = 0
+
+
+def timed_schedd(name, ads):
+    """Pass through ads from a schedd query, recording how long the schedd
+    took to send them (not how long the consumer took) and how many it sent.
+    """
+    waited = 0.
+    count = 0
+    it = iter(ads)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                ad = next(it)
+            except StopIteration:
+                break
+            finally:
+                waited += time.perf_counter() - start
+            count += 1
+            yield ad
+    finally:
+        schedd_query_seconds.labels(name).observe(waited)
+        schedd_ads.labels(name).inc(count)
+
+
+def register(target=REGISTRY):
+    """Expose the stage metrics from a long-running exporter"""
+    target.register(registry)
+
+
+def write_textfile(path):
+    """Write the stage metrics for node_exporter's textfile collector.
+
+    With PROMETHEUS_MULTIPROC_DIR set (before prometheus_client is first
+    imported), the metrics of every process using that directory, such as
+    pool workers, are summed up.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        target = CollectorRegistry()
+        multiprocess.MultiProcessCollector(target)
+    else:
+        target = registry
+    write_to_textfile(path, target)
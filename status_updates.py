@@ -0,0 +1,182 @@
+"""
+The condor_status update scripts, applied client-side
+"""
+
+import copy
+import logging
+from itertools import islice
+
+from cachetools import LRUCache
+
+# note different capitalization conventions for GPU and Cpu
+RESOURCES = ("GPUs", "Cpus", "Memory", "Disk")
+STATUSES = ("evicted", "removed", "finished", "failed")
+
+
+def update_occupancy(source, resource):
+    """Recompute occupancy.*.<resource> of a glidein doc, like the scripts do.
+
+    Returns:
+        list: fields that were set
+    """
+    norm = float(source["duration"]) * float(source["Total" + resource])
+    if not (norm > 0):
+        return []
+    fields = []
+    total = 0.
+    for status in STATUSES:
+        key = status + "." + resource
+        if source.get("claims." + key) is not None:
+            source["occupancy." + key] = source["claims." + key] / norm
+            total += source["claims." + key] / norm
+        else:
+            source["occupancy." + key] = 0
+        fields.append("occupancy." + key)
+    source["occupancy.total." + resource] = total
+    fields.append("occupancy.total." + resource)
+    return fields
+
+
+def update_machine(source, duration, LastHeardFrom):
+    """Apply the <index>-update-machine script to a glidein doc.
+
+    Fields are replaced, never modified in place, so a shallow copy of
+    `source` can be updated and thrown away if the script fails.
+
+    Returns:
+        list: fields that changed (empty if the script would be a no-op)
+    """
+    if not (source.get("duration") is None or source["duration"] < duration):
+        return []
+    source["duration"] = duration
+    if isinstance(source.get("@timestamp"), list):
+        source["@timestamp"] = source["@timestamp"] + [LastHeardFrom]
+    else:
+        source["@timestamp"] = [source.get("DaemonStartTime"), source.get("LastHeardFrom"), LastHeardFrom]
+    source["LastHeardFrom"] = LastHeardFrom
+    fields = ["duration", "@timestamp", "LastHeardFrom"]
+    for resource in RESOURCES:
+        if "Total" + resource not in source:
+            continue
+        fields += update_occupancy(source, resource)
+    return fields
+
+
+def update_job(source, job, category, requests):
+    """Apply the <index>-update-jobs script to a glidein doc, replacing
+    fields like `update_machine`.
+
+    Returns:
+        list: fields that changed (empty if the script would be a no-op)
+    """
+    fields = []
+    if source.get("jobs." + category) is None:
+        source["jobs." + category] = []
+        for resource in RESOURCES:
+            source["claims." + category + "." + resource] = 0.0
+            fields.append("claims." + category + "." + resource)
+    if job in source["jobs." + category]:
+        return []
+    source["jobs." + category] = source["jobs." + category] + [job]
+    fields.append("jobs." + category)
+    for resource in RESOURCES:
+        if resource in requests:
+            source["claims." + category + "." + resource] += float(requests[resource])
+            fields.append("claims." + category + "." + resource)
+        if "Total" + resource not in source or source.get("duration") is None:
+            continue
+        fields += update_occupancy(source, resource)
+    return fields
+
+
+class ClientSideUpdates:
+    """Turn scripted update actions into plain writes.
+
+    Takes the actions generated for the `-update-machine` and `-update-jobs`
+    stored scripts, fetches the docs they target, applies the scripts here,
+    and yields one partial-doc update per changed doc and window (or an
+    index op for a new doc, where ES would have used the upsert).
+
+    Docs written earlier in the same stream are kept in an LRU cache, as
+    their writes may not have been acknowledged yet when a later window
+    fetches them. Updates carry whole field values from that cache, and
+    may follow the index op creating their doc, so the actions have to be
+    applied in order, one bulk request at a time.
+
+    Args:
+        es (Elasticsearch): client to fetch docs with
+        window (int): actions fetched and applied at a time
+        cache_size (int): number of written docs to remember
+    """
+    def __init__(self, es, window=1000, cache_size=50000):
+        self.es = es
+        self.window = window
+        self.cache_size = cache_size
+
+    def fetch(self, keys):
+        """Get the sources of (index, id) docs, None for docs that do not exist"""
+        sources = {}
+        if not keys:
+            return sources
+        resp = self.es.mget(docs=[{"_index": index, "_id": doc_id} for index, doc_id in keys])
+        for key, doc in zip(keys, resp["docs"]):
+            sources[key] = doc["_source"] if doc.get("found") else None
+        return sources
+
+    def convert(self, actions):
+        cache = LRUCache(self.cache_size)
+        actions = iter(actions)
+        missing = 0
+        while True:
+            window = list(islice(actions, self.window))
+            if not window:
+                break
+            keys = list(dict.fromkeys((a["_index"], a["_id"]) for a in window))
+            sources = {key: cache[key] for key in keys if key in cache}
+            sources.update(self.fetch([key for key in keys if key not in sources]))
+
+            changed = {}
+            for action in window:
+                key = (action["_index"], action["_id"])
+                source = sources[key]
+                if source is None:
+                    if "upsert" in action:
+                        # ES indexes the upsert doc as it is, without running the script
+                        sources[key] = copy.deepcopy(action["upsert"])
+                        changed[key] = None
+                    else:
+                        missing += 1
+                    continue
+                params = action["script"]["params"]
+                updated = dict(source)
+                try:
+                    if action["script"]["id"].endswith("-update-machine"):
+                        fields = update_machine(updated, params["duration"], params["LastHeardFrom"])
+                    else:
+                        fields = update_job(updated, params["job"], params["category"], params["requests"])
+                except (TypeError, ValueError, KeyError):
+                    # the script would fail too, leaving the doc alone
+                    logging.warning("failed to update %s/%s", *key, exc_info=True)
+                    continue
+                if fields:
+                    sources[key] = updated
+                if fields and key in changed and changed[key] is not None:
+                    changed[key].update(dict.fromkeys(fields))
+                elif fields and key not in changed:
+                    changed[key] = dict.fromkeys(fields)
+
+            for key, fields in changed.items():
+                index, doc_id = key
+                source = sources[key]
+                cache[key] = source
+                if fields is None:
+                    yield {"_op_type": "index", "_index": index, "_id": doc_id, "_source": source}
+                else:
+                    yield {
+                        "_op_type": "update",
+                        "_index": index,
+                        "_id": doc_id,
+                        "doc": {k: source[k] for k in fields},
+                    }
+        if missing:
+            logging.warning("%d updates for glidein docs that do not exist", missing)
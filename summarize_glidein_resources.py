@@ -8,13 +8,20 @@ from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import elasticsearch
 import elasticsearch_dsl as edsl
 import datetime
-import dateutil
+import dateutil.parser
 import re
+import os
+import sys
+import json
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, urlunparse
 from rest_tools.client import ClientCredentialsAuth
 
+import es_bulk
+import glidein_overlap
+
 # note different capitalization conventions for GPU and Cpu
 RESOURCES = ("GPUs", "Cpus", "Memory", "Disk")
 STATUSES = ("evicted", "removed", "finished", "failed")
@@ -109,11 +116,15 @@ def get_datetime(value):
     try:
         return datetime.datetime.now(datetime.timezone.utc) - parse_timedelta(value)
     except ValueError:
-        return dateutil.parser.parse(value)
+        dt = dateutil.parser.parse(value)
+        # dates without a zone are UTC, like the index timestamps
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return dt
 
 
 def snap_to_interval(dt, interval):
-    ts = time.mktime(dt.timetuple())
+    ts = dt.timestamp()
     ts = ts - (ts % int(interval.total_seconds()))
     return datetime.datetime.fromtimestamp(ts,tz=datetime.timezone.utc)
 
@@ -125,33 +136,94 @@ def parse_index(url_str):
         "index": url.path[1:],
     }
 
-def scan_aggs(search, source_aggs, inner_aggs={}, size=10):
+def get_max_buckets(client, default=65536):
+    """The cluster's search.max_buckets limit"""
+    try:
+        settings = client.cluster.get_settings(include_defaults=True, flat_settings=True)
+    except elasticsearch.ApiError:
+        logging.warning("could not read cluster settings, assuming max_buckets=%d", default)
+        return default
+    for level in ("transient", "persistent", "defaults"):
+        if "search.max_buckets" in settings.get(level, {}):
+            return int(settings[level]["search.max_buckets"])
+    return default
+
+
+def scan_aggs(search, source_aggs, inner_aggs={}, size=None, buckets_per_key=1, max_buckets=65536,
+              concurrency=4):
     """
     Helper function used to iterate over all possible bucket combinations of
     ``source_aggs``, returning results of ``inner_aggs`` for each. Uses the
     ``composite`` aggregation under the hood to perform this.
+
+    With ``inner_aggs``, the combinations are first listed with a cheap
+    composite aggregation without them. Pages of the full aggregation are
+    then fetched ``concurrency`` at a time, each starting after the last
+    key of the page before it. Buckets are yielded in key order.
+
+    ``size`` is the number of combinations per page. By default it is the
+    most that keeps a page under ``max_buckets``, given that each
+    combination makes ``buckets_per_key`` buckets.
     """
+    names = [name for source in source_aggs for name in source]
 
-    def run_search(**kwargs):
+    def key_tuple(key):
+        return tuple(key[name] for name in names)
+
+    def run_search(size, after=None, inner=True):
         s = search[:0]
-        s.aggs.bucket("comp", "composite", sources=source_aggs, size=size, **kwargs)
-        for agg_name, agg in inner_aggs.items():
-            s.aggs["comp"][agg_name] = agg
+        if after is not None:
+            s.aggs.bucket("comp", "composite", sources=source_aggs, size=size, after=after)
+        else:
+            s.aggs.bucket("comp", "composite", sources=source_aggs, size=size)
+        if inner:
+            for agg_name, agg in inner_aggs.items():
+                s.aggs["comp"][agg_name] = agg
         return s.execute()
 
-    response = run_search()
-    while response.aggregations.comp.buckets:
-        for b in response.aggregations.comp.buckets:
-            yield b
-        if "after_key" in response.aggregations.comp:
-            after = response.aggregations.comp.after_key
-        else:
-            after = response.aggregations.comp.buckets[-1].key
-        response = run_search(after=after)
+    def scan(size, after=None, end=None, inner=True):
+        """Buckets after `after`, up to and including `end`"""
+        while True:
+            comp = run_search(size, after, inner).aggregations.comp
+            if not comp.buckets:
+                return
+            for b in comp.buckets:
+                if end is not None and key_tuple(b.key) > end:
+                    return
+                yield b
+            if end is not None and key_tuple(comp.buckets[-1].key) == end:
+                return
+            if "after_key" in comp:
+                after = comp.after_key.to_dict()
+            else:
+                after = comp.buckets[-1].key.to_dict()
+
+    if size is None:
+        # leave room for bins at the edges of the histogram
+        size = max(1, (max_buckets // 2) // max(1, buckets_per_key))
+
+    if not inner_aggs or concurrency <= 1:
+        yield from scan(size)
+        return
+
+    keys = [b.key.to_dict() for b in scan(max_buckets // 2, inner=False)]
+    logging.info("fetching %d bucket combinations in pages of %d", len(keys), size)
+    pages = [(None, None)]
+    for i in range(size, len(keys), size):
+        # a page ends where the next one starts, so combinations that
+        # appeared since the keys were listed are still picked up
+        pages[-1] = (pages[-1][0], key_tuple(keys[i-1]))
+        pages.append((keys[i-1], None))
 
+    with ThreadPoolExecutor(concurrency) as pool:
+        for buckets in pool.map(lambda page: list(scan(size, *page)), pages):
+            yield from buckets
 
-def resource_summaries(client, index, after, before, interval):
+
+def resource_summaries(client, index, after, before, interval, max_buckets=None, concurrency=4):
     parsed_interval = parse_timedelta(interval)
+    if max_buckets is None:
+        max_buckets = get_max_buckets(client)
     by_site = [
         {k: edsl.A("terms", field=k + ".keyword")}
         for k in ("site", "country", "institution", "resource")
@@ -170,6 +242,8 @@ def resource_summaries(client, index, after, before, interval):
         "date_histogram",
         field="@timestamp",
         fixed_interval=interval,
+        # only bins in the query range count against max_buckets
+        hard_bounds={"min": after, "max": before},
     )
     by_timestamp.bucket("resources", summarize_resources(int(parsed_interval.total_seconds() * 1000)))
 
@@ -182,7 +256,10 @@ def resource_summaries(client, index, after, before, interval):
         ),
         by_site,
         {"timestamp": by_timestamp},
-        size=1,
+        # one composite bucket, and a histogram bin for each interval
+        buckets_per_key=int((before - after) / parsed_interval) + 2,
+        max_buckets=max_buckets,
+        concurrency=concurrency,
     )
     for site in buckets:
         for bucket in site.timestamp.buckets:
@@ -208,6 +285,64 @@ def make_insert(generator, index, id_keys=["timestamp", "resource", "site", "slo
         data.update(key)
         yield data
 
+
+def load_state(path):
+    """Last finalized bin per output index, from an incremental state file"""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {k: datetime.datetime.fromisoformat(v) for k, v in state.items()}
+
+
+def save_state(path, state):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({k: v.isoformat() for k, v in state.items()}, f, indent=2)
+    os.replace(tmp, path)
+
+
+def windows(after, before, step):
+    """Split [after, before) into consecutive windows no longer than step"""
+    while after < before:
+        yield after, min(after + step, before)
+        after += step
+
+
+def summarize(es, options, after, before):
+    """Compute and write (or print) the bins in [after, before)"""
+    logging.info("summarizing %s to %s", after, before)
+    if options.engine == "exact":
+        buckets = glidein_overlap.resource_summaries(
+            es,
+            options.input_index,
+            after,
+            before,
+            parse_timedelta(options.interval),
+            slices=options.slices,
+        )
+    else:
+        buckets = resource_summaries(
+            es,
+            options.input_index,
+            after,
+            before,
+            options.interval,
+            max_buckets=options.max_buckets,
+            concurrency=options.concurrency,
+        )
+
+    if options.dry_run:
+        for bucket in make_insert(buckets, None):
+            json.dump(bucket, sys.stdout)
+            sys.stdout.write("\n")
+    else:
+        success, _ = es_bulk.bulk(
+            es, make_insert(buckets, options.output_index), max_retries=20, initial_backoff=2, max_backoff=3600,
+        )
+        logging.info("indexed %d bins", success)
+
 if __name__ == '__main__':
     parser = ArgumentParser(
         description=__doc__, formatter_class=ArgumentDefaultsHelpFormatter
@@ -221,6 +356,22 @@ if __name__ == '__main__':
     parser.add_argument(
         "--interval", default="20m", help="aggregation interval",
     )
+    parser.add_argument(
+        "--engine", default="painless", choices=("painless", "exact"),
+        help="aggregate in ES with a scripted metric, or scroll the glideins and weight each bin by its exact overlap",
+    )
+    parser.add_argument(
+        "--slices", default=4, type=int,
+        help="parallel scroll slices for the exact engine",
+    )
+    parser.add_argument(
+        "--max-buckets", default=None, type=int,
+        help="bucket limit per search (default: the cluster's search.max_buckets)",
+    )
+    parser.add_argument(
+        "--concurrency", default=4, type=int,
+        help="aggregation pages to fetch at once",
+    )
     parser.add_argument(
         "-y",
         "--dry-run",
@@ -248,6 +399,33 @@ if __name__ == '__main__':
     parser.add_argument('--client_secret',help='oauth2 client secret',default=None)
     parser.add_argument('--token_url',help='oauth2 realm token url',default=None)
 
+    subparsers = parser.add_subparsers(
+        dest="command", metavar="{incremental,backfill}",
+        help="without a command, summarize --after to --before",
+    )
+    incremental = subparsers.add_parser(
+        "incremental", formatter_class=ArgumentDefaultsHelpFormatter,
+        help="summarize only bins that are new or may still change since the last run",
+    )
+    incremental.add_argument(
+        "--state-file", required=True,
+        help="JSON file with the last finalized bin per output index (--after is used if there is none)",
+    )
+    incremental.add_argument(
+        "--late-margin", default="6h", type=parse_timedelta,
+        help="keep recomputing bins this long after they close, for late or extended glidein ads",
+    )
+    backfill = subparsers.add_parser(
+        "backfill", formatter_class=ArgumentDefaultsHelpFormatter,
+        help="summarize a historical window, without touching incremental state",
+    )
+    backfill.add_argument("start", type=get_datetime, help="start of the window")
+    backfill.add_argument("end", type=get_datetime, help="end of the window")
+    backfill.add_argument(
+        "--chunk", default="1d", type=parse_timedelta,
+        help="summarize and index the window this much at a time",
+    )
+
     options = parser.parse_args()
 
     logging.basicConfig(
@@ -256,11 +434,23 @@ if __name__ == '__main__':
     if options.verbose:
         logging.getLogger("elasticsearch").setLevel("DEBUG")
 
-    # round time range to nearest interval
+    now = datetime.datetime.now(datetime.timezone.utc)
     interval_delta =  parse_timedelta(options.interval)
+    if options.command == "backfill":
+        options.after, options.before = options.start, options.end
+    elif options.command == "incremental":
+        state = load_state(options.state_file)
+        state_key = options.output_index or ""
+        if state_key in state:
+            options.after = state[state_key]
+        else:
+            logging.info("no state for %r, starting from %s", state_key, options.after)
+        options.before = now
+
+    # round time range to nearest interval
     after = snap_to_interval(options.after, interval_delta)
     # ...only if last bin is far enough in the past to be complete
-    if datetime.datetime.now(datetime.timezone.utc) - options.before >  interval_delta:
+    if now - options.before >  interval_delta:
         before = snap_to_interval(options.before,  interval_delta)
     else:
         before = options.before
@@ -289,22 +479,16 @@ if __name__ == '__main__':
                 bearer_auth=token,
                 sniff_on_node_failure=True)
 
-    buckets = resource_summaries(
-        es,
-        options.input_index,
-        after,
-        before,
-        options.interval,
-    )
-
-    if options.dry_run:
-        import json
-        import sys
-
-        for bucket in make_insert(buckets):
-            json.dump(bucket, sys.stdout)
-            sys.stdout.write("\n")
+    if options.command == "backfill":
+        for start, end in windows(after, before, options.chunk):
+            summarize(es, options, start, end)
     else:
-        success, _ = elasticsearch.helpers.bulk(
-            es, make_insert(buckets, options.output_index), max_retries=20, initial_backoff=2, max_backoff=3600,
-        )
+        summarize(es, options, after, before)
+
+    if options.command == "incremental" and not options.dry_run:
+        # bins that closed more than --late-margin ago will not be recomputed
+        finalized = min(snap_to_interval(now - options.late_margin, interval_delta), before)
+        if state_key not in state or finalized > state[state_key]:
+            state[state_key] = finalized
+            save_state(options.state_file, state)
+            logging.info("bins before %s are final", finalized)
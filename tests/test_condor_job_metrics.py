@@ -0,0 +1,66 @@
+import json
+import random
+
+import pytest
+
+pytest.importorskip('prometheus_client')
+
+from prometheus_client import REGISTRY
+
+from condor_job_metrics import JOB_LABELS, JobMetrics
+
+
+def unregister(metrics):
+    for name in list(metrics.family_labels) + ['condor_job_metrics_folded_values']:
+        REGISTRY.unregister(getattr(metrics, name))
+
+
+def samples(metrics):
+    return {(s.name, tuple(sorted(s.labels.items()))): s.value
+            for name in metrics.family_labels
+            for family in getattr(metrics, name).collect()
+            for s in family.samples if not s.name.endswith('_created')}
+
+
+def test_snapshot_round_trip():
+    rand = random.Random(1)
+    metrics = JobMetrics(limits={'owner': 2}, drop={'condor_job_mem_used': ['site']})
+    try:
+        for i in range(500):
+            labels = metrics.fold({l: f'{l}{rand.randrange(3)}' for l in JOB_LABELS})
+            metrics.child('condor_job_walltime_hours', labels).inc(rand.random() * 10)
+            metrics.child('condor_job_count', labels).inc()
+            metrics.child('condor_job_mem_req', labels).observe(rand.choice((.5, 1, 2.5, 7, 100)))
+            metrics.child('condor_job_mem_used', labels).observe(rand.random() * 50)
+            metrics.child('condor_job_resource_req', labels).observe(rand.randrange(1, 20))
+        # as saved to the state file
+        state = json.loads(json.dumps(metrics.snapshot()))
+        expected = samples(metrics)
+    finally:
+        unregister(metrics)
+
+    restored = JobMetrics(limits={'owner': 2}, drop={'condor_job_mem_used': ['site']})
+    try:
+        restored.restore(state)
+        actual = samples(restored)
+        assert actual.keys() == expected.keys()
+        assert actual == pytest.approx(expected)
+        assert restored.guards['owner'].kept == metrics.guards['owner'].kept
+    finally:
+        unregister(restored)
+
+
+def test_restore_skips_changed_buckets():
+    metrics = JobMetrics()
+    try:
+        metrics.child('condor_job_mem_req', {l: 'x' for l in JOB_LABELS}).observe(2)
+        state = metrics.snapshot()
+    finally:
+        unregister(metrics)
+    state['families']['condor_job_mem_req']['buckets'] = ['1.0', 'inf']
+    restored = JobMetrics()
+    try:
+        restored.restore(state)
+        assert not any(name.startswith('condor_job_mem_req') for name, _ in samples(restored))
+    finally:
+        unregister(restored)
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+
+import pytest
+
+for module in ('htcondor2', 'classad2', 'elasticsearch', 'elasticsearch_dsl', 'rest_tools', 'prometheus_client'):
+    pytest.importorskip(module)
+
+import condor_status_to_es
+
+
+class Serializer:
+    def dumps(self, data):
+        return json.dumps(data).encode()
+
+
+class ScriptedClient:
+    """Applies scripted updates, failing those to a doc another request is
+    updating at the same time with a version conflict, like ES does"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.updating = {}
+        self.count = {}
+        self.requests = 0
+        serializer = Serializer()
+        class Serializers:
+            def get_serializer(self, mimetype):
+                return serializer
+        class Transport:
+            serializers = Serializers()
+        self.transport = Transport()
+
+    def bulk(self, operations, **kwargs):
+        ids = [json.loads(line)['update']['_id'] for line in operations[::2]]
+        with self.lock:
+            self.requests += 1
+            busy = {i for i in ids if self.updating.get(i)}
+            for i in set(ids):
+                self.updating[i] = self.updating.get(i, 0) + 1
+        time.sleep(.5)
+        items = []
+        with self.lock:
+            for i in ids:
+                if i in busy:
+                    items.append({'update': {'_id': i, 'status': 409,
+                                             'error': {'type': 'version_conflict_engine_exception'}}})
+                else:
+                    self.count[i] = self.count.get(i, 0) + 1
+                    items.append({'update': {'_id': i, 'status': 200}})
+            for i in set(ids):
+                self.updating[i] -= 1
+        return {'items': items}
+
+
+def test_updates_to_one_doc_do_not_conflict():
+    client = ScriptedClient()
+    # two chunks of 5000 updates to the same glidein
+    actions = ({'_op_type': 'update', '_index': 'condor_status', '_id': 'glidein',
+                'script': {'id': 'condor_status-update-jobs',
+                           'params': {'job': f'job{i}', 'category': 'finished', 'requests': {}}}}
+               for i in range(10000))
+    assert condor_status_to_es.es_import(actions, client) == 10000
+    assert client.requests == 2
+    assert client.count['glidein'] == 10000
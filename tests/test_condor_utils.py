@@ -0,0 +1,28 @@
+import math
+
+import pytest
+
+for module in ('classad2', 'prometheus_client'):
+    pytest.importorskip(module)
+
+import condor_utils
+from condor_utils import filter_keys, isoformat_dates
+
+
+@pytest.mark.parametrize('value', [1e12, -1e11, math.nan, 'soon'])
+def test_bad_dates_fall_back_to_zero(value):
+    condor_utils.bad_values.clear()
+    data = {'JobCurrentStartDate': value}
+    filter_keys(data, now=1700000000.)
+    assert data['JobCurrentStartDate'] == 0
+    assert condor_utils.bad_values['date', 'JobCurrentStartDate'] == 1
+    isoformat_dates(data)
+    assert data['JobCurrentStartDate'] == '1970-01-01T00:00:00'
+
+
+def test_dates():
+    data = {'JobCurrentStartDate': 1700000000}
+    filter_keys(data, now=1700000000.)
+    assert data['QDate'] == 1700000000.
+    isoformat_dates(data)
+    assert data['JobCurrentStartDate'] == '2023-11-14T22:13:20'
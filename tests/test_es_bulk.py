@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('elasticsearch')
+pytest.importorskip('prometheus_client')
+
+from elasticsearch.helpers import BulkIndexError
+
+import es_bulk
+
+
+class Serializer:
+    def dumps(self, data):
+        return json.dumps(data).encode()
+
+
+class FakeClient:
+    """Answers bulk requests, failing the documents with ids in `bad`"""
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.requests = 0
+        serializer = Serializer()
+        class Serializers:
+            def get_serializer(self, mimetype):
+                return serializer
+        class Transport:
+            serializers = Serializers()
+        self.transport = Transport()
+
+    def bulk(self, operations, **kwargs):
+        self.requests += 1
+        items = []
+        for line in operations[::2]:
+            meta = json.loads(line)['index']
+            if meta['_id'] in self.bad:
+                items.append({'index': {'_id': meta['_id'], 'status': 400,
+                                        'error': {'type': 'mapper_parsing_exception'}}})
+            else:
+                items.append({'index': {'_id': meta['_id'], 'status': 201}})
+        return {'items': items}
+
+
+def actions(n):
+    return ({'_index': 'test', '_id': str(i), 'value': i} for i in range(n))
+
+
+def big_chunks():
+    # one request per 5000 actions, whatever their size
+    return es_bulk.Throttle(chunk_bytes=1<<30, max_chunk_bytes=1<<30)
+
+
+def test_results_in_order():
+    results = list(es_bulk.streaming_bulk(FakeClient(), actions(12000), throttle=big_chunks()))
+    assert [info['index']['_id'] for ok, info in results] == [str(i) for i in range(12000)]
+    assert all(ok for ok, info in results)
+
+
+def test_failed_chunk_raises_before_yielding():
+    client = FakeClient(bad={'7500'})
+    seen = []
+    with pytest.raises(BulkIndexError):
+        for ok, info in es_bulk.streaming_bulk(client, actions(12000), throttle=big_chunks()):
+            seen.append(info['index']['_id'])
+    # nothing of the second chunk, which holds the failure
+    assert seen == [str(i) for i in range(5000)]
+
+
+def test_checkpoint_does_not_pass_failure():
+    acks = []
+    results = es_bulk.streaming_bulk(FakeClient(bad={'2500'}), actions(5000), throttle=big_chunks())
+    with pytest.raises(BulkIndexError):
+        for _ in es_bulk.ack_results(results, acks.append, every=500):
+            pass
+    assert all(n <= 2500 for n in acks)
+
+
+def test_checkpoint_without_raising():
+    acks = []
+    results = es_bulk.streaming_bulk(FakeClient(bad={'2500'}), actions(5000), throttle=big_chunks(),
+                                     raise_on_error=False)
+    list(es_bulk.ack_results(results, acks.append, every=500))
+    assert max(acks) == 2500
+
+
+def test_dead_letter_acknowledges_failures():
+    acks = []
+    dead = []
+    results = es_bulk.streaming_bulk(FakeClient(bad={'2500'}), actions(5000), throttle=big_chunks(),
+                                     dead_letter=dead.append)
+    list(es_bulk.ack_results(results, acks.append, every=500, dead_letter=True))
+    assert len(dead) == 1
+    assert max(acks) == 5000
+
+
+def test_bulk_counts():
+    success, errors = es_bulk.bulk(FakeClient(bad={'3'}), actions(10), raise_on_error=False)
+    assert success == 9
+    assert len(errors) == 1
+
+
+def test_one_request_at_a_time():
+    client = FakeClient()
+    lock = threading.Lock()
+    active, most = [0], [0]
+    bulk = client.bulk
+    def slow_bulk(operations, **kwargs):
+        with lock:
+            active[0] += 1
+            most[0] = max(most[0], active[0])
+        time.sleep(.01)
+        try:
+            return bulk(operations, **kwargs)
+        finally:
+            with lock:
+                active[0] -= 1
+    client.bulk = slow_bulk
+    throttle = es_bulk.Throttle(concurrency=1, max_concurrency=1, chunk_bytes=1<<30, max_chunk_bytes=1<<30)
+    success, errors = es_bulk.bulk(client, actions(5000), chunk_size=500, throttle=throttle)
+    assert success == 5000
+    assert client.requests == 10
+    assert most[0] == 1
@@ -0,0 +1,32 @@
+from glidein_index import GlideinIndex
+
+
+def test_lookup_after_commit(tmp_path):
+    index = GlideinIndex(str(tmp_path / 'glideins.db'))
+    index.add('slot1@host', 1000., 'doc1', 'glidein-resources')
+    assert index.lookup('slot1@host', 2000.) is None
+    index.commit(500., 1500.)
+    assert index.lookup('slot1@host', 2000.) == ('glidein-resources', 'doc1')
+
+
+def test_last_update_is_query_time(tmp_path):
+    index = GlideinIndex(str(tmp_path / 'glideins.db'))
+    index.commit(500., 1500.)
+    assert index._get('last_update') == 1500.
+
+    # the next query reaches back to the last one: no gap
+    index.commit(1400., 2500.)
+    assert index.covered_since == 500.
+
+    # a query that does not reach back to the last one leaves a gap
+    index.commit(2600., 3500.)
+    assert index.covered_since == 2600.
+
+
+def test_discard(tmp_path):
+    index = GlideinIndex(str(tmp_path / 'glideins.db'))
+    index.commit(500., 1500.)
+    index.add('slot1@host', 1000., 'doc1', 'glidein-resources')
+    index.discard()
+    index.commit(1400., 2500.)
+    assert index.lookup('slot1@host', 2000.) is None
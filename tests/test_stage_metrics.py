@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('prometheus_client')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# prometheus_client picks multiprocess mode when it is first imported, so
+# run in a fresh interpreter
+SCRIPT = '''
+import multiprocessing, sys
+import stage_metrics
+
+def work(n):
+    stage_metrics.record('parse', 1., n)
+    stage_metrics.bulk_seconds.observe(.3)
+
+if __name__ == '__main__':
+    with multiprocessing.get_context('fork').Pool(2) as pool:
+        pool.map(work, [1, 2, 3, 4])
+    stage_metrics.record('parse', 1., 10)
+    stage_metrics.write_textfile(sys.argv[1])
+'''
+
+
+def test_textfile_sums_workers(tmp_path):
+    textfile = tmp_path / 'stages.prom'
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path / 'multiproc'))
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + sys.path)
+    os.mkdir(env['PROMETHEUS_MULTIPROC_DIR'])
+    subprocess.run([sys.executable, '-c', SCRIPT, str(textfile)], env=env, check=True)
+    lines = textfile.read_text().splitlines()
+    assert 'monitoring_stage_items_total{stage="parse"} 20.0' in lines
+    assert 'monitoring_stage_seconds_total{stage="parse"} 5.0' in lines
+    assert 'monitoring_es_bulk_seconds_count 4.0' in lines
@@ -0,0 +1,179 @@
+import copy
+import logging
+
+import pytest
+
+pytest.importorskip('cachetools')
+
+from status_updates import ClientSideUpdates, update_job, update_machine
+
+INDEX = 'glidein-resources'
+
+# a glidein doc, and what the painless scripts turn it into
+GLIDEIN = {
+    'Name': 'slot1@host',
+    'DaemonStartTime': 100,
+    'LastHeardFrom': 200,
+    'duration': 100,
+    'TotalCpus': 4,
+    'TotalGPUs': 0,
+    'TotalMemory': 8000,
+    'jobs.finished': ['job0'],
+    'claims.finished.GPUs': 0.0,
+    'claims.finished.Cpus': 200.0,
+    'claims.finished.Memory': 0.0,
+    'claims.finished.Disk': 0.0,
+}
+
+# <index>-update-machine with duration=300, LastHeardFrom=400
+MACHINE_UPDATED = dict(GLIDEIN, **{
+    'duration': 300,
+    '@timestamp': [100, 200, 400],
+    'LastHeardFrom': 400,
+    # TotalGPUs is 0, so no GPU occupancy; no TotalDisk, so no disk occupancy
+    'occupancy.evicted.Cpus': 0,
+    'occupancy.removed.Cpus': 0,
+    'occupancy.finished.Cpus': 200/1200,
+    'occupancy.failed.Cpus': 0,
+    'occupancy.total.Cpus': 200/1200,
+    'occupancy.evicted.Memory': 0,
+    'occupancy.removed.Memory': 0,
+    'occupancy.finished.Memory': 0.,
+    'occupancy.failed.Memory': 0,
+    'occupancy.total.Memory': 0.,
+})
+
+# <index>-update-jobs with job=job1, category=evicted, requests={Cpus: 100, Memory: 80000}
+JOB_UPDATED = dict(GLIDEIN, **{
+    'jobs.evicted': ['job1'],
+    'claims.evicted.GPUs': 0.0,
+    'claims.evicted.Cpus': 100.0,
+    'claims.evicted.Memory': 80000.0,
+    'claims.evicted.Disk': 0.0,
+    'occupancy.evicted.Cpus': 100/400,
+    'occupancy.removed.Cpus': 0,
+    'occupancy.finished.Cpus': 200/400,
+    'occupancy.failed.Cpus': 0,
+    'occupancy.total.Cpus': 300/400,
+    'occupancy.evicted.Memory': 80000/800000,
+    'occupancy.removed.Memory': 0,
+    'occupancy.finished.Memory': 0.,
+    'occupancy.failed.Memory': 0,
+    'occupancy.total.Memory': 80000/800000,
+})
+
+
+def machine_action(doc_id, duration, LastHeardFrom, upsert=None):
+    action = {
+        '_index': INDEX, '_op_type': 'update', '_id': doc_id,
+        'script': {'id': INDEX + '-update-machine',
+                   'params': {'duration': duration, 'LastHeardFrom': LastHeardFrom}},
+    }
+    if upsert is not None:
+        action['upsert'] = upsert
+    return action
+
+
+def job_action(doc_id, job, category, requests):
+    return {
+        '_index': INDEX, '_op_type': 'update', '_id': doc_id,
+        'script': {'id': INDEX + '-update-jobs',
+                   'params': {'job': job, 'category': category, 'requests': requests}},
+    }
+
+
+class FakeES:
+    """Answers mget from a dict of docs by id"""
+    def __init__(self, docs):
+        self.docs = docs
+        self.fetched = []
+
+    def mget(self, docs):
+        self.fetched.append([d['_id'] for d in docs])
+        return {'docs': [{'_id': d['_id'], 'found': True, '_source': copy.deepcopy(self.docs[d['_id']])}
+                         if d['_id'] in self.docs else {'_id': d['_id'], 'found': False}
+                         for d in docs]}
+
+
+def test_update_machine():
+    source = copy.deepcopy(GLIDEIN)
+    fields = update_machine(source, 300, 400)
+    assert source == pytest.approx(MACHINE_UPDATED)
+    assert set(fields) == (MACHINE_UPDATED.keys() - GLIDEIN.keys()) | {'duration', 'LastHeardFrom'}
+
+
+def test_update_machine_noop():
+    source = copy.deepcopy(GLIDEIN)
+    assert update_machine(source, 100, 400) == []
+    assert source == GLIDEIN
+
+
+def test_update_job():
+    source = copy.deepcopy(GLIDEIN)
+    fields = update_job(source, 'job1', 'evicted', {'GPUs': 0, 'Cpus': 100, 'Memory': 80000})
+    assert source == pytest.approx(JOB_UPDATED)
+    assert 'jobs.evicted' in fields and 'occupancy.total.Cpus' in fields
+
+
+def test_update_job_noop():
+    source = copy.deepcopy(GLIDEIN)
+    assert update_job(source, 'job0', 'finished', {'Cpus': 100}) == []
+    assert source == GLIDEIN
+
+
+def test_convert_partial_update():
+    es = FakeES({'a': GLIDEIN})
+    ops = list(ClientSideUpdates(es).convert([machine_action('a', 300, 400, upsert={'x': 1})]))
+    assert len(ops) == 1
+    assert ops[0]['_op_type'] == 'update'
+    doc = dict(GLIDEIN, **ops[0]['doc'])
+    assert doc == pytest.approx(MACHINE_UPDATED)
+
+
+def test_convert_noop():
+    es = FakeES({'a': GLIDEIN})
+    assert list(ClientSideUpdates(es).convert([job_action('a', 'job0', 'finished', {'Cpus': 1})])) == []
+
+
+def test_convert_upsert():
+    # ES indexes the upsert as it is, and later scripts in the stream run on it
+    es = FakeES({})
+    upsert = copy.deepcopy(GLIDEIN)
+    ops = list(ClientSideUpdates(es).convert([
+        machine_action('a', 100, 200, upsert=upsert),
+        job_action('a', 'job1', 'evicted', {'GPUs': 0, 'Cpus': 100, 'Memory': 80000}),
+    ]))
+    assert len(ops) == 1
+    assert ops[0]['_op_type'] == 'index'
+    assert ops[0]['_source'] == pytest.approx(JOB_UPDATED)
+
+
+def test_convert_missing_doc(caplog):
+    # without an upsert, ES fails the update with document_missing
+    es = FakeES({})
+    with caplog.at_level(logging.WARNING):
+        ops = list(ClientSideUpdates(es).convert([job_action('a', 'job1', 'evicted', {'Cpus': 100})]))
+    assert ops == []
+    assert '1 updates for glidein docs that do not exist' in caplog.text
+
+
+def test_convert_uses_written_docs():
+    # the second window must not read the doc back, the first write may not be applied yet
+    es = FakeES({'a': GLIDEIN})
+    ops = list(ClientSideUpdates(es, window=1).convert([
+        machine_action('a', 300, 400),
+        job_action('a', 'job1', 'evicted', {'GPUs': 0, 'Cpus': 100, 'Memory': 80000}),
+    ]))
+    assert es.fetched == [['a']]
+    assert len(ops) == 2
+    doc = dict(GLIDEIN, **ops[0]['doc'])
+    doc.update(ops[1]['doc'])
+    expected = dict(JOB_UPDATED, **{k: v for k, v in MACHINE_UPDATED.items() if not k.startswith('occupancy')})
+    expected.update({
+        'occupancy.evicted.Cpus': 100/1200,
+        'occupancy.finished.Cpus': 200/1200,
+        'occupancy.total.Cpus': 300/1200,
+        'occupancy.evicted.Memory': 80000/2400000,
+        'occupancy.total.Memory': 80000/2400000,
+    })
+    assert doc == pytest.approx(expected)
@@ -0,0 +1,43 @@
+import datetime
+import time
+
+import pytest
+
+for module in ('dateutil', 'elasticsearch', 'elasticsearch_dsl', 'rest_tools', 'numpy', 'prometheus_client'):
+    pytest.importorskip(module)
+
+from summarize_glidein_resources import get_datetime, snap_to_interval
+
+
+def test_date_without_zone_is_utc():
+    dt = get_datetime('2024-01-01')
+    assert dt == datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    # as main does with the backfill range
+    assert datetime.datetime.now(datetime.timezone.utc) - dt > datetime.timedelta(0)
+
+
+def test_date_with_zone():
+    dt = get_datetime('2024-01-01T06:00:00-06:00')
+    assert dt == datetime.datetime(2024, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+
+def test_relative_time():
+    dt = get_datetime('1h')
+    assert dt.tzinfo is not None
+    expected = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+    assert abs(dt - expected) < datetime.timedelta(minutes=1)
+
+
+@pytest.mark.parametrize('tz', ['UTC', 'America/Chicago', 'Asia/Kolkata'])
+def test_snap_is_stable(monkeypatch, tz):
+    monkeypatch.setenv('TZ', tz)
+    time.tzset()
+    try:
+        interval = datetime.timedelta(hours=1)
+        dt = datetime.datetime(2024, 1, 1, 12, 30, tzinfo=datetime.timezone.utc)
+        once = snap_to_interval(dt, interval)
+        assert once == datetime.datetime(2024, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        assert snap_to_interval(once, interval) == once
+    finally:
+        monkeypatch.undo()
+        time.tzset()